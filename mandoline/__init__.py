@@ -1,3 +1,5 @@
 from validators import *
+from aggregators import *
 from cleaners import *
-from mandoline import *
\ No newline at end of file
+from mandoline import *
+from columnar import *
@@ -0,0 +1,294 @@
+"""
+Reducers combine the values of a field within each group when
+MandolineCleaner.aggregate groups rows.
+
+aggregate("Completion Count", Mean("Score"), Count(output_name="rows"))
+"""
+
+import cPickle
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger("mandoline.aggregators")
+
+
+class Reducer(object):
+    """
+    Reduces a field to a single value per group.
+
+    Each group keeps one accumulator per reducer. start() returns a new
+    accumulator, add() folds a value into it, merge() combines two
+    accumulators for the same group and result() gives the output value.
+    """
+
+    def __init__(self, field_name, output_name=None):
+        self.field_name = field_name
+        self.output_name = output_name or field_name
+
+    def start(self):
+        return None
+
+    def add(self, acc, value):
+        raise NotImplementedError
+
+    def merge(self, acc, other):
+        raise NotImplementedError
+
+    def result(self, acc):
+        return acc
+
+
+class Sum(Reducer):
+    """
+    Sum the values in each group
+    """
+
+    def start(self):
+        return 0
+
+    def add(self, acc, value):
+        return acc + value
+
+    merge = add
+
+
+class Count(Reducer):
+    """
+    Count the rows in each group. If a field_name is given, only count
+    rows where that field isn't None.
+
+    Count(output_name="rows")
+    """
+
+    def __init__(self, field_name=None, output_name=None):
+        Reducer.__init__(self, field_name, output_name or field_name or "count")
+
+    def start(self):
+        return 0
+
+    def add(self, acc, value):
+        if value is None and self.field_name is not None:
+            return acc
+        return acc + 1
+
+    def merge(self, acc, other):
+        return acc + other
+
+
+class Min(Reducer):
+    """
+    The smallest value in each group, ignoring None
+    """
+
+    def add(self, acc, value):
+        if acc is None or (value is not None and value < acc):
+            return value
+        return acc
+
+    merge = add
+
+
+class Max(Reducer):
+    """
+    The largest value in each group, ignoring None
+    """
+
+    def add(self, acc, value):
+        if acc is None or (value is not None and value > acc):
+            return value
+        return acc
+
+    merge = add
+
+
+class Mean(Reducer):
+    """
+    The average of the values in each group, ignoring None
+    """
+
+    def start(self):
+        return (0, 0)
+
+    def add(self, acc, value):
+        if value is None:
+            return acc
+        return (acc[0] + value, acc[1] + 1)
+
+    def merge(self, acc, other):
+        return (acc[0] + other[0], acc[1] + other[1])
+
+    def result(self, acc):
+        if not acc[1]:
+            return None
+        return float(acc[0]) / acc[1]
+
+
+class DistinctCount(Reducer):
+    """
+    The number of different values in each group
+    """
+
+    def start(self):
+        return set()
+
+    def add(self, acc, value):
+        acc.add(value)
+        return acc
+
+    def merge(self, acc, other):
+        acc.update(other)
+        return acc
+
+    def result(self, acc):
+        return len(acc)
+
+
+def as_reducer(reducer):
+    """
+    Field names are summed, as aggregate has always done
+    """
+    if isinstance(reducer, basestring):
+        return Sum(reducer)
+    return reducer
+
+
+def aggregated_fields(flds, reducers):
+    """
+    Returns (key_fields, output_fields). Fields that aren't reduced are
+    the keys. Reducer outputs take the place of the field they reduce in
+    the output, and outputs that don't reduce a field come last.
+    """
+    by_field = {}
+    for r in reducers:
+        by_field.setdefault(r.field_name, []).append(r.output_name)
+
+    key_fields = [f for f in flds if f not in by_field]
+    output_fields = []
+    for f in flds:
+        output_fields.extend(by_field.pop(f, [f]))
+    for r in reducers:
+        if r.field_name in by_field:
+            output_fields.append(r.output_name)
+    return key_fields, output_fields
+
+
+class HashAggregator(object):
+    """
+    Groups rows by key_fields in a single pass, keeping a list of
+    accumulators per group.
+
+    If max_groups is set and more groups than that are seen, the
+    accumulators are spilled to partition files on disk (partitioned by
+    a hash of the key) and each partition is merged separately as the
+    aggregated rows are read.
+    """
+
+    def __init__(self, key_fields, reducers, max_groups=None,
+                 partitions=16, spill_dir=None):
+        self.key_fields = list(key_fields)
+        self.reducers = list(reducers)
+        self.max_groups = max_groups
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.spill_files = None
+        self.spills = 0
+
+    def _key_function(self):
+        if len(self.key_fields) == 1:
+            key_field = self.key_fields[0]
+            return lambda row: (row[key_field],)
+        key_fields = self.key_fields
+        return lambda row: tuple([row[k] for k in key_fields])
+
+    def _spill(self, groups):
+        if self.spill_files is None:
+            self.tempdir = tempfile.mkdtemp(prefix='mandoline-aggregate-',
+                                            dir=self.spill_dir)
+            self.spill_files = [
+                open(os.path.join(self.tempdir, str(i)), 'w+b')
+                for i in range(self.partitions)]
+        logger.info("Spilling %d groups to disk" % len(groups))
+        self.spills += 1
+        for key, accs in groups.iteritems():
+            cPickle.dump((key, accs),
+                         self.spill_files[hash(key) % self.partitions],
+                         cPickle.HIGHEST_PROTOCOL)
+        groups.clear()
+
+    def _merge_partition(self, f):
+        merges = [r.merge for r in self.reducers]
+        groups = {}
+        f.seek(0)
+        while True:
+            try:
+                key, accs = cPickle.load(f)
+            except EOFError:
+                break
+            current = groups.get(key)
+            if current is None:
+                groups[key] = accs
+            else:
+                groups[key] = [merge(a, b) for merge, a, b in
+                               zip(merges, current, accs)]
+        return groups
+
+    def _rows(self, groups):
+        key_fields = self.key_fields
+        outputs = [(r.output_name, r.result) for r in self.reducers]
+        for key, accs in groups.iteritems():
+            row = dict(zip(key_fields, key))
+            for (name, result), acc in zip(outputs, accs):
+                row[name] = result(acc)
+            yield row
+
+    def _remove_spill_files(self):
+        if self.spill_files is None:
+            return
+        for f in self.spill_files:
+            f.close()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+        self.spill_files = None
+
+    def _spilled_rows(self):
+        try:
+            for f in self.spill_files:
+                for row in self._rows(self._merge_partition(f)):
+                    yield row
+        finally:
+            self._remove_spill_files()
+
+    def aggregate(self, rows):
+        """
+        Returns the aggregated rows: a list, or if groups were spilled to
+        disk an iterator that merges one partition at a time. The spill
+        files are removed when it is exhausted or closed.
+        """
+        key_function = self._key_function()
+        starts = [r.start for r in self.reducers]
+        adds = [(idx, r.add, r.field_name)
+                for idx, r in enumerate(self.reducers)]
+        max_groups = self.max_groups
+
+        groups = {}
+        spilled = False
+        try:
+            for row in rows:
+                key = key_function(row)
+                accs = groups.get(key)
+                if accs is None:
+                    if max_groups is not None and len(groups) >= max_groups:
+                        self._spill(groups)
+                    accs = groups[key] = [start() for start in starts]
+                for idx, add, field_name in adds:
+                    accs[idx] = add(accs[idx], row.get(field_name))
+
+            if self.spill_files is None:
+                return list(self._rows(groups))
+            self._spill(groups)
+            spilled = True
+            return self._spilled_rows()
+        finally:
+            if not spilled:
+                self._remove_spill_files()
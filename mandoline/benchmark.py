@@ -0,0 +1,317 @@
+"""
+Times each stage of the cleaning pipeline on generated files
+
+    python -m mandoline.benchmark --rows 100000 --width 12 --output results.json
+
+Each stage is reported with its rows per second and the peak memory of
+the process once it finished. The csv file is cleaned with dict rows and
+again with compact rows, and the memory the loaded and cleaned rows take
+is reported for both. Saved results can be compared across versions to
+spot regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cleaners import Date, FieldCleaner, Int, StateAbbrevLookup
+from mandoline import MandolineCleaner, MandolineMasher
+from metrics import peak_memory_kb
+from rows import CompactRow
+
+STATES = ["Virginia", "Georgia", "new york", "California", "Texas", "Ohio"]
+NAMES = 100
+MASHED_FILES = 4
+
+# What importing mandoline cost when it loaded everything up front
+EAGER_IMPORTS = ["requests", "boto.s3.connection", "numpy", "openpyxl"]
+
+STARTUP_SCRIPT = """
+import resource, sys, time
+start = time.time()
+import mandoline
+for name in sys.argv[1:]:
+    __import__(name)
+seconds = time.time() - start
+print seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+
+def columns(width):
+    """
+    The header of a generated file with width columns (at least 4)
+    """
+    header = ["Name", "State", "Date", "Count"]
+    header.extend("Value %d" % i for i in range(1, max(width, 4) - 3))
+    return header
+
+
+def generate_row(i, width):
+    row = ["name %d" % (i % NAMES), STATES[i % len(STATES)],
+           "%02d-%02d-%d" % (i % 12 + 1, i % 28 + 1, 2010 + i % 4), str(i)]
+    for col in range(max(width, 4) - 4):
+        if col % 2:
+            row.append("text %d" % ((i + col) % 1000))
+        else:
+            row.append(str((i * col) % 10000))
+    return row
+
+
+def write_csv(path, rows, width):
+    import csv
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns(width))
+        for i in xrange(rows):
+            writer.writerow(generate_row(i, width))
+    return path
+
+
+def write_xlsx(path, rows, width):
+    from openpyxl import Workbook
+    wb = Workbook(optimized_write=True)
+    ws = wb.create_sheet()
+    ws.append(columns(width))
+    for i in xrange(rows):
+        row = generate_row(i, width)
+        row[3] = i
+        ws.append(row)
+    wb.save(path)
+    return path
+
+
+def numeric_columns(width):
+    return [name for idx, name in enumerate(columns(width)[4:])
+            if idx % 2 == 0]
+
+
+def fields(width):
+    """
+    FieldCleaners for a generated file: the built-in cleaners on the first
+    four columns and Int on the numeric value columns
+    """
+    numeric = numeric_columns(width)
+    result = [FieldCleaner("Name"),
+              FieldCleaner("State", StateAbbrevLookup()),
+              FieldCleaner("Date", Date()),
+              FieldCleaner("Count", Int())]
+    for name in columns(width)[4:]:
+        if name in numeric:
+            result.append(FieldCleaner(name, Int()))
+        else:
+            result.append(FieldCleaner(name))
+    return result
+
+
+def rows_memory_kb(rows):
+    """
+    The memory taken by the rows themselves, not counting their values
+    """
+    getsizeof = sys.getsizeof
+    size = getsizeof(rows)
+    for row in rows:
+        size += getsizeof(row)
+        if isinstance(row, CompactRow):
+            size += getsizeof(row.data)
+            if row.extra is not None:
+                size += getsizeof(row.extra)
+    return size // 1024
+
+
+class Benchmark(object):
+    """
+    Generates a csv and an xlsx file with rows rows and width columns in
+    workdir and times each stage on them
+    """
+
+    def __init__(self, rows=10000, width=10, xlsx_rows=None, workdir=None):
+        self.rows = rows
+        self.width = width
+        self.xlsx_rows = rows if xlsx_rows is None else xlsx_rows
+        self.workdir = workdir
+        self.results = []
+
+    def _time(self, fmt, stage, fn, rows, rows_of=None):
+        start = time.time()
+        fn()
+        seconds = time.time() - start
+        result = {
+            'format': fmt,
+            'stage': stage,
+            'rows': rows,
+            'seconds': round(seconds, 4),
+            'rows_per_sec': round(rows / seconds, 1) if seconds else None,
+            'peak_memory_kb': peak_memory_kb(),
+            'rows_kb': rows_memory_kb(rows_of()) if rows_of else None,
+        }
+        self.results.append(result)
+        return result
+
+    def _run_cleaner(self, fmt, fn, rows, compact=False):
+        cleaner = MandolineCleaner(compact_rows=compact)
+        cleaner.set_fields(*fields(self.width))
+        suffix = ' (compact)' if compact else ''
+        if fmt == 'csv':
+            load = lambda: cleaner.loadcsv(fn)
+        else:
+            load = lambda: cleaner.loadxlsx(fn)
+        self._time(fmt, 'load' + suffix, load, rows,
+                   lambda: cleaner.inputrows)
+        self._time(fmt, 'clean' + suffix, cleaner._cleanrows, rows,
+                   lambda: cleaner.rows)
+        cleaned = cleaner.rows
+
+        self._time(fmt, 'to_csv' + suffix,
+                   lambda: cleaner.to_csv(fn + '.out.csv'), rows)
+        self._time(fmt, 'to_json' + suffix,
+                   lambda: cleaner.to_json(fn + '.out.json'), rows)
+
+        reduced = numeric_columns(self.width)
+        self._time(fmt, 'aggregate' + suffix,
+                   lambda: cleaner.aggregate("Count", *reduced), rows)
+
+        cleaner.rows = cleaned
+        self._time(fmt, 'refine_fieldnames' + suffix,
+                   cleaner.refine_fieldnames, rows)
+
+    def _run_masher(self, fn):
+        for i in range(MASHED_FILES):
+            part = os.path.join(self.workdir, "part%d.csv" % i)
+            try:
+                os.link(fn, part)
+            except (AttributeError, OSError):
+                shutil.copyfile(fn, part)
+        masher = MandolineMasher().files(os.path.join(self.workdir,
+                                                      "part*.csv"))
+        self._time('csv', 'MandolineMasher.to_csv',
+                   lambda: masher.to_csv(os.path.join(self.workdir,
+                                                      "mashed.csv")),
+                   self.rows * MASHED_FILES)
+
+    def run(self):
+        cleanup = self.workdir is None
+        if cleanup:
+            self.workdir = tempfile.mkdtemp(prefix='mandoline-benchmark-')
+        try:
+            csv_fn = write_csv(os.path.join(self.workdir, "input.csv"),
+                               self.rows, self.width)
+            self._run_cleaner('csv', csv_fn, self.rows)
+            self._run_cleaner('csv', csv_fn, self.rows, compact=True)
+            if self.xlsx_rows:
+                xlsx_fn = write_xlsx(os.path.join(self.workdir, "input.xlsx"),
+                                     self.xlsx_rows, self.width)
+                self._run_cleaner('xlsx', xlsx_fn, self.xlsx_rows)
+            self._run_masher(csv_fn)
+        finally:
+            if cleanup:
+                shutil.rmtree(self.workdir, ignore_errors=True)
+                self.workdir = None
+        return self
+
+    def _import_time(self, modules):
+        """
+        (seconds, peak memory) of importing mandoline and then modules in
+        a new interpreter
+        """
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(
+            __file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [package_dir] + filter(None, [env.get('PYTHONPATH')]))
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT] + modules, env=env)
+        seconds, peak = output.split()
+        return float(seconds), int(peak)
+
+    def run_startup(self, runs=5):
+        """
+        Time importing mandoline on its own and with the dependencies it
+        used to import eagerly, taking the fastest of runs tries
+        """
+        available = []
+        for name in EAGER_IMPORTS:
+            try:
+                __import__(name)
+                available.append(name)
+            except ImportError:
+                pass
+        for stage, modules in (('import mandoline', []),
+                               ('import with dependencies', available)):
+            times = [self._import_time(modules) for _ in range(runs)]
+            seconds, peak = min(times)
+            self.results.append({
+                'format': 'python',
+                'stage': stage,
+                'rows': 0,
+                'seconds': round(seconds, 4),
+                'rows_per_sec': None,
+                'peak_memory_kb': peak,
+                'rows_kb': None,
+            })
+        return self
+
+    def report(self, label=None):
+        return {
+            'label': label,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'rows': self.rows,
+            'xlsx_rows': self.xlsx_rows,
+            'width': self.width,
+            'results': self.results,
+        }
+
+    def show(self):
+        print "%-6s %-30s %10s %10s %12s %12s %10s" % (
+            "format", "stage", "rows", "seconds", "rows/sec", "peak KB",
+            "rows KB")
+        for r in self.results:
+            print "%-6s %-30s %10d %10.3f %12s %12d %10s" % (
+                r['format'], r['stage'], r['rows'], r['seconds'],
+                r['rows_per_sec'], r['peak_memory_kb'],
+                r['rows_kb'] if r['rows_kb'] is not None else '-')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time the stages of the mandoline cleaning pipeline")
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="rows in the generated csv file")
+    parser.add_argument('--xlsx-rows', type=int, default=None,
+                        help="rows in the generated xlsx file, 0 to skip it "
+                             "(defaults to --rows)")
+    parser.add_argument('--width', type=int, default=10,
+                        help="columns in the generated files")
+    parser.add_argument('--workdir', default=None,
+                        help="where to write the generated files")
+    parser.add_argument('--label', default=None,
+                        help="a name for this run, such as a version")
+    parser.add_argument('--output', default=None,
+                        help="save the results as json to this file")
+    parser.add_argument('--startup', action='store_true',
+                        help="also time importing mandoline")
+    args = parser.parse_args(argv)
+
+    logging.getLogger('mandoline').setLevel(logging.WARNING)
+    benchmark = Benchmark(args.rows, args.width, args.xlsx_rows,
+                          args.workdir).run()
+    if args.startup:
+        benchmark.run_startup()
+    benchmark.show()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark.report(args.label), f, indent=2,
+                      sort_keys=True)
+    return benchmark
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,16 @@
 import csv
 import cStringIO
 import codecs
+import json
 import logging
+import re
+from math import isinf, isnan
+from collections import OrderedDict, deque
+from datetime import date, datetime
+from time import mktime
+
+from metrics import cleaner_name, timed
+from rows import MISSING, CompactRow
 
 
 logger = logging.getLogger("mandoline.cleaners")
@@ -39,6 +48,240 @@ class DictUnicodeWriter(object):
         self.writer.writeheader()
 
 
+class BufferedDictUnicodeWriter(object):
+    """
+    Writes dict rows to f as csv in the given encoding
+
+    Each value is encoded once, and rows are written to f in batches of
+    batch_size. Keys that aren't in fieldnames are ignored and missing
+    keys are written as restval.
+    """
+
+    def __init__(self, f, fieldnames, dialect=csv.excel, encoding="utf-8",
+                 restval="", batch_size=1000, **kwds):
+        self.stream = f
+        self.fieldnames = list(fieldnames)
+        self.encoding = encoding
+        self.restval = restval
+        self.batch_size = batch_size
+        self.queue = cStringIO.StringIO()
+        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+        self.count = 0
+
+    def _encode(self, v):
+        if isinstance(v, unicode):
+            return v.encode(self.encoding)
+        if isinstance(v, str):
+            return v
+        return str(v)
+
+    def _flush(self):
+        self.stream.write(self.queue.getvalue())
+        self.queue.seek(0)
+        self.queue.truncate()
+
+    def writeheader(self, names=None):
+        """
+        Write fieldnames, or names in their place
+        """
+        if names is None:
+            names = self.fieldnames
+        self.writer.writerow([self._encode(k) for k in names])
+        self._flush()
+
+    def writerow(self, D):
+        self.writerows((D,))
+
+    def writerows(self, rows):
+        encode = self._encode
+        fieldnames = self.fieldnames
+        restval = self.restval
+        writerow = self.writer.writerow
+        batch_size = self.batch_size
+        pending = 0
+        for D in rows:
+            if D.__class__ is CompactRow:
+                values = D.values_for(fieldnames, restval)
+                writerow([encode(v) for v in values])
+            else:
+                writerow([encode(D.get(k, restval)) for k in fieldnames])
+            self.count += 1
+            pending += 1
+            if pending == batch_size:
+                self._flush()
+                pending = 0
+        self._flush()
+
+
+def _json_row(obj):
+    """
+    Encode CompactRows as json objects
+    """
+    if isinstance(obj, CompactRow):
+        return obj.as_dict()
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+class JSONRowsWriter(object):
+    """
+    Writes a slice rows cache one row at a time, with compact separators
+
+    With layout "rows" the output is {"rows": [{field: value, ...}, ...]}.
+    With layout "arrays" field names are written once:
+    {"fields": [field, ...], "rows": [[value, ...], ...]}
+
+    Only the keys in fieldnames are written. If names is given, the
+    field in each position of fieldnames is written under that name.
+    """
+
+    layouts = ("rows", "arrays")
+
+    def __init__(self, f, fieldnames, layout="rows", batch_size=1000,
+                 names=None):
+        assert layout in self.layouts, "Unknown layout " + layout
+        self.stream = f
+        self.fieldnames = list(fieldnames)
+        self.names = self.fieldnames if names is None else list(names)
+        assert len(self.names) == len(self.fieldnames), \
+            "Needs a name for every field"
+        self.layout = layout
+        self.batch_size = batch_size
+        self.encode = json.JSONEncoder(separators=(',', ':'),
+                                       default=_json_row).encode
+        self.count = 0
+
+    def writerows(self, rows):
+        """
+        Write the whole document, rows can be any iterable of dicts or
+        CompactRows
+        """
+        encode = self.encode
+        if self.layout == "arrays":
+            fieldnames = self.fieldnames
+            self.stream.write('{"fields":%s,"rows":[' % encode(self.names))
+            rows = (row.values_for(fieldnames) if row.__class__ is CompactRow
+                    else [row.get(k) for k in fieldnames] for row in rows)
+        else:
+            self.stream.write('{"rows":[')
+            rows = self._objects(rows)
+
+        batch = []
+        for row in rows:
+            batch.append(encode(row))
+            if len(batch) == self.batch_size:
+                self._writebatch(batch)
+                batch = []
+        self._writebatch(batch)
+        self.stream.write(']}')
+
+    def _objects(self, rows):
+        """
+        Rows that have other keys than fieldnames, or whose fields are
+        renamed, are rebuilt one at a time as they are written
+        """
+        fieldnames = self.fieldnames
+        pairs = zip(fieldnames, self.names)
+        keys = frozenset(fieldnames)
+        renamed = self.names != fieldnames
+        for row in rows:
+            if row.__class__ is CompactRow:
+                if renamed or row.extra or row.schema.fields != fieldnames:
+                    row = dict((name, row[k]) for k, name in pairs
+                               if k in row)
+            elif renamed or not keys.issuperset(row):
+                row = dict((name, row[k]) for k, name in pairs if k in row)
+            yield row
+
+    def _writebatch(self, batch):
+        if not batch:
+            return
+        if self.count:
+            self.stream.write(',')
+        self.stream.write(',\n'.join(batch))
+        self.count += len(batch)
+
+
+class LRUCache(object):
+    """
+    A mapping of at most maxsize items that evicts the least recently
+    used key and counts cache hits and misses
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+
+class ValueCache(object):
+    """
+    A dict of at most maxsize values for cleaners to look up on every row.
+    A hit is a single dict lookup: keys aren't reordered when they are
+    read, and once the cache is full the oldest key is evicted when a new
+    one is added. The keys of initial are always kept and don't count
+    towards maxsize.
+    """
+
+    def __init__(self, maxsize=1024, initial=None):
+        self.maxsize = maxsize
+        self.data = dict(initial or {})
+        self._order = deque()
+        self.get = self.data.get
+
+    def __setitem__(self, key, value):
+        if self.maxsize <= 0:
+            return
+        if key not in self.data:
+            if len(self._order) >= self.maxsize:
+                del self.data[self._order.popleft()]
+            self._order.append(key)
+        self.data[key] = value
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getstate__(self):
+        return self.maxsize, self.data, self._order
+
+    def __setstate__(self, state):
+        self.maxsize, self.data, self._order = state
+        self.get = self.data.get
+
+
 class FieldRowCleaner():
     pass
 
@@ -78,6 +321,63 @@ class CleanWith(FieldRowCleaner):
         self.clean_func(d, fn)
 
 
+class Memoize(FieldRowCleaner):
+    """
+    Remember what a cleaner turns each distinct value into, so it only
+    runs once per value. The cleaner (or cleaning function, which is
+    wrapped in CleanWith) must only depend on the value of the field.
+
+    Memoize(CleanWith(expensive_regex_cleanup), cache_size=1000)
+
+    Up to cache_size values are kept in a ValueCache, self.cache. hits,
+    misses and hit_rate tell how well the cache is working.
+    """
+
+    def __init__(self, cleaner, cache_size=1024):
+        if not isinstance(cleaner, FieldRowCleaner):
+            cleaner = CleanWith(cleaner)
+        assert not isinstance(cleaner, Rename), "Can not memoize a Rename"
+        self.cleaner = cleaner
+        self.cache = ValueCache(cache_size)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clean(self, d, fn):
+        value = d[fn]
+        try:
+            result = self.cache.get(value, self)
+        except TypeError:
+            # unhashable values aren't cached
+            self.cleaner.clean(d, fn)
+            return
+        if result is self:
+            self.misses += 1
+            self.cleaner.clean(d, fn)
+            self.cache[value] = d[fn]
+        else:
+            self.hits += 1
+            d[fn] = result
+
+
+_punctuation = re.compile(r'[^\w\s]', re.UNICODE)
+
+
+def normalize_key(value):
+    """
+    Uppercase a string, drop punctuation and collapse whitespace
+
+    normalize_key(" New  york. ") => "NEW YORK"
+    """
+    if not isinstance(value, basestring):
+        return value
+    return ' '.join(_punctuation.sub('', value).split()).upper()
+
+
 class Lookup(FieldRowCleaner):
     """
     Use a lookup table to determine a new value for a field
@@ -90,81 +390,135 @@ class Lookup(FieldRowCleaner):
     { "a": 1 }  => { "a": 2 }
     { "a": 2 }  => { "a": 4 } # gets the default value
 
+    If normalize, keys and values are compared ignoring case, punctuation
+    and extra whitespace. The normalized index is built from lookup when
+    the Lookup is made. It is kept in a ValueCache with the results for up
+    to cache_size other distinct values, so each row is one dict lookup.
+
+    Lookup({"New York": "NY"}, normalize=True)
+
+    { "a": "new york." }  => { "a": "NY" }
     """
 
-    def __init__(self, lookup, default=None):
+    def __init__(self, lookup, default=None, normalize=False,
+                 cache_size=10000):
         self.lookup = lookup
         self.default = default
+        self.normalize = normalize
+        self.cache_size = cache_size
+        self._index = None
+        if normalize:
+            self._index = dict((normalize_key(k), v)
+                               for k, v in lookup.iteritems())
+            self._resolved = ValueCache(cache_size, self._index)
+
+    def lookup_value(self, value):
+        """
+        The cleaned value for value
+        """
+        if self._index is not None:
+            result = self._index.get(normalize_key(value), self)
+        else:
+            result = self.lookup.get(value, self)
+        if result is self:
+            return value if self.default is None else self.default
+        return result
 
     def clean(self, d, fn):
-        if self.default is None:
+        if self._index is not None:
+            value = d[fn]
+            result = self._resolved.get(value, self)
+            if result is self:
+                result = self._resolved[value] = self.lookup_value(value)
+            d[fn] = result
+        elif self.default is None:
             d[fn] = self.lookup.get(d[fn], d[fn])
         else:
             d[fn] = self.lookup.get(d[fn], self.default)
 
 
 class StateAbbrevLookup(Lookup):
+    """
+    Convert state names to their two letter abbreviations, ignoring case,
+    punctuation and extra whitespace
+    """
+
+    states = {
+        "DISTRICT OF COLUMBIA": "DC",
+        "ALABAMA": "AL",
+        "ALASKA": "AK",
+        "ARIZONA": "AZ",
+        "ARKANSAS": "AR",
+        "CALIFORNIA": "CA",
+        "COLORADO": "CO",
+        "CONNECTICUT": "CT",
+        "DELAWARE": "DE",
+        "FLORIDA": "FL",
+        "GEORGIA": "GA",
+        "HAWAII": "HI",
+        "IDAHO": "ID",
+        "ILLINOIS": "IL",
+        "INDIANA": "IN",
+        "IOWA": "IA",
+        "KANSAS": "KS",
+        "KENTUCKY": "KY",
+        "LOUISIANA": "LA",
+        "MAINE": "ME",
+        "MARYLAND": "MD",
+        "MASSACHUSETTS": "MA",
+        "MICHIGAN": "MI",
+        "MINNESOTA": "MN",
+        "MISSISSIPPI": "MS",
+        "MISSOURI": "MO",
+        "MONTANA": "MT",
+        "NEBRASKA": "NE",
+        "NEVADA": "NV",
+        "NEW HAMPSHIRE": "NH",
+        "NEW JERSEY": "NJ",
+        "NEW MEXICO": "NM",
+        "NEW YORK": "NY",
+        "NORTH CAROLINA": "NC",
+        "NORTH DAKOTA": "ND",
+        "OHIO": "OH",
+        "OKLAHOMA": "OK",
+        "OREGON": "OR",
+        "PENNSYLVANIA": "PA",
+        "RHODE ISLAND": "RI",
+        "SOUTH CAROLINA": "SC",
+        "SOUTH DAKOTA": "SD",
+        "TENNESSEE": "TN",
+        "TEXAS": "TX",
+        "UTAH": "UT",
+        "VERMONT": "VT",
+        "VIRGINIA": "VA",
+        "WASHINGTON": "WA",
+        "WEST VIRGINIA": "WV",
+        "WISCONSIN": "WI",
+        "WYOMING": "WY",
+    }
+
     def __init__(self, default=None):
-        self.default = default
-        self.lookup = {
-            "DISTRICT OF COLUMBIA": "DC",
-            "ALABAMA": "AL",
-            "ALASKA": "AK",
-            "ARIZONA": "AZ",
-            "ARKANSAS": "AR",
-            "CALIFORNIA": "CA",
-            "COLORADO": "CO",
-            "CONNECTICUT": "CT",
-            "DELAWARE": "DE",
-            "FLORIDA": "FL",
-            "GEORGIA": "GA",
-            "HAWAII": "HI",
-            "IDAHO": "ID",
-            "ILLINOIS": "IL",
-            "INDIANA": "IN",
-            "IOWA": "IA",
-            "KANSAS": "KS",
-            "KENTUCKY": "KY",
-            "LOUISIANA": "LA",
-            "MAINE": "ME",
-            "MARYLAND": "MD",
-            "MASSACHUSETTS": "MA",
-            "MICHIGAN": "MI",
-            "MINNESOTA": "MN",
-            "MISSISSIPPI": "MS",
-            "MISSOURI": "MO",
-            "MONTANA": "MT",
-            "NEBRASKA": "NE",
-            "NEVADA": "NV",
-            "NEW HAMPSHIRE": "NH",
-            "NEW JERSEY": "NJ",
-            "NEW MEXICO": "NM",
-            "NEW YORK": "NY",
-            "NORTH CAROLINA": "NC",
-            "NORTH DAKOTA": "ND",
-            "OHIO": "OH",
-            "OKLAHOMA": "OK",
-            "OREGON": "OR",
-            "PENNSYLVANIA": "PA",
-            "RHODE ISLAND": "RI",
-            "SOUTH CAROLINA": "SC",
-            "SOUTH DAKOTA": "SD",
-            "TENNESSEE": "TN",
-            "TEXAS": "TX",
-            "UTAH": "UT",
-            "VERMONT": "VT",
-            "VIRGINIA": "VA",
-            "WASHINGTON": "WA",
-            "WEST VIRGINIA": "WV",
-            "WISCONSIN": "WI",
-            "WYOMING": "WY",
-        }
+        Lookup.__init__(self, self.states, default, normalize=True)
 
-    def clean(self, d, fn):
-        if self.default is None:
-            d[fn] = self.lookup.get(d[fn].upper(), d[fn])
-        else:
-            d[fn] = self.lookup.get(d[fn].upper(), self.default)
+
+def _number_text(value, thousands, decimal):
+    """
+    Strip thousands separators from a number and use '.' as its decimal
+    point. Raises ValueError if a thousands separator isn't followed by
+    exactly three digits, as in "1,5" or "1,2,3".
+    """
+    value = value.strip()
+    if thousands and thousands in value:
+        whole, _, fraction = value.partition(decimal)
+        groups = whole.lstrip('+-').split(thousands)
+        if (thousands in fraction or not 1 <= len(groups[0]) <= 3 or
+                not all(len(g) == 3 for g in groups[1:]) or
+                not all(g.isdigit() for g in groups)):
+            raise ValueError("Misplaced thousands separator in %r" % value)
+        value = value.replace(thousands, '')
+    if decimal != '.':
+        value = value.replace(decimal, '.')
+    return value
 
 
 class Int(FieldRowCleaner):
@@ -173,53 +527,183 @@ class Int(FieldRowCleaner):
 
     Int("a", 0)
     { "a": "1" } => { "a": 1 }
+    { "a": "-12" } => { "a": -12 }
     { "a": "fred" } => { "a": 0 }
 
+    Values like "3.0" are accepted, "3.5" is not. Pass thousands="," to
+    accept "1,234", and decimal="," for numbers like "1.234,0". A
+    thousands separator must be followed by three digits, so "1,5" is
+    not an integer. With default=None, values that aren't integers
+    become None.
     """
 
-    def __init__(self, default=0):
+    def __init__(self, default=0, thousands=None, decimal='.'):
         self.default = default
+        self.thousands = thousands
+        self.decimal = decimal
+
+    def parse(self, value):
+        """
+        The integer value, or None
+        """
+        if isinstance(value, float):
+            return int(value) if value.is_integer() else None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
+        if not isinstance(value, basestring):
+            return None
+        try:
+            text = _number_text(value, self.thousands, self.decimal)
+        except ValueError:
+            return None
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            number = float(text)
+        except ValueError:
+            return None
+        return int(number) if number.is_integer() else None
 
     def clean(self, d, fn):
-        s = str(d[fn])
-        if s.isdigit():
-            d[fn] = int(s)
-        else:
-            assert self.default is not None, "Failed to parse an integer without a default"
-            d[fn] = self.default
+        value = self.parse(d[fn])
+        d[fn] = self.default if value is None else value
+
+
+class Float(FieldRowCleaner):
+    """
+    Convert a value to a float, optionally taking a default value
+
+    Float()
+    { "a": "1.5" } => { "a": 1.5 }
+    { "a": "fred" } => { "a": None }
+
+    Pass thousands="," to accept "1,234.5", and decimal="," (with
+    thousands=".") for numbers like "1.234,5".
+    """
+
+    def __init__(self, default=None, thousands=None, decimal='.'):
+        self.default = default
+        self.thousands = thousands
+        self.decimal = decimal
+
+    def parse(self, value):
+        """
+        The float value, or None
+        """
+        if (isinstance(value, basestring) and
+                (self.thousands or self.decimal != '.')):
+            # "1.234" is 1234.0 with thousands=".", not 1.234
+            try:
+                value = _number_text(value, self.thousands, self.decimal)
+            except ValueError:
+                return None
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return None
+        if isinf(number) or isnan(number):
+            return None
+        return number
+
+    def clean(self, d, fn):
+        value = self.parse(d[fn])
+        d[fn] = self.default if value is None else value
+
+
+def _epoch_ms(year, month, day):
+    # date() raises ValueError for days that do not exist
+    date(year, month, day)
+    return int(mktime((year, month, day, 0, 0, 0, 0, 0, -1))) * 1000
+
+
+def _split_date(value, widths):
+    # Like strptime, years must have 4 digits, months and days 1 or 2
+    parts = value.split('-')
+    if len(parts) != 3:
+        raise ValueError("Not a date: %r" % value)
+    for part, (shortest, longest) in zip(parts, widths):
+        if not (shortest <= len(part) <= longest and part.isdigit()):
+            raise ValueError("Not a date: %r" % value)
+    return [int(part) for part in parts]
+
+
+def _parse_mdy(value):
+    month, day, year = _split_date(value, ((1, 2), (1, 2), (4, 4)))
+    return _epoch_ms(year, month, day)
+
+
+def _parse_iso(value):
+    year, month, day = _split_date(value, ((4, 4), (1, 2), (1, 2)))
+    return _epoch_ms(year, month, day)
 
 
 class Date(FieldRowCleaner):
     """
-    Convert a value to an integer, optionally taking a default value
+    Convert a date string to milliseconds since the epoch, or None if the
+    value doesn't match the format
 
-    Int("a", 0)
-    { "a": "1" } => { "a": 1 }
-    { "a": "fred" } => { "a": 0 }
+    Date("%m-%d-%Y")
+    { "a": "07-10-2013" } => { "a": 1373428800000 }
+    { "a": "fred" } => { "a": None }
 
+    The common formats "%m-%d-%Y" and "%Y-%m-%d" are parsed without
+    strptime. If cache_size is given, parsed values are kept in a
+    ValueCache of that size, available as self.cache, and self.hits and
+    self.misses count how often it was used.
     """
 
-    def __init__(self, format="%m-%d-%Y"):
+    fast_parsers = {
+        "%m-%d-%Y": _parse_mdy,
+        "%Y-%m-%d": _parse_iso,
+    }
+
+    def __init__(self, format="%m-%d-%Y", cache_size=None):
         self.format = format
+        self.parser = self.fast_parsers.get(format, self._strptime)
+        self.cache = ValueCache(cache_size) if cache_size else None
+        self.hits = 0
+        self.misses = 0
 
-    def clean(self, d, fn):
-        from datetime import datetime
-        from time import mktime
+    def _strptime(self, value):
+        dt = datetime.strptime(value, self.format)
+        # multiply by 1000 to convert to ms
+        return int(mktime(dt.timetuple())) * 1000
 
+    def parse(self, value):
         try:
-            dt = datetime.strptime(d[fn], self.format)
-            # multiply by 1000 to convert to ms
-            d[fn] = int(mktime(dt.timetuple())) * 1000
-        except:
-            d[fn] = None
+            return self.parser(value)
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def clean(self, d, fn):
+        value = d[fn]
+        if self.cache is None:
+            d[fn] = self.parse(value)
+            return
+        result = self.cache.get(value, self)
+        if result is self:
+            self.misses += 1
+            result = self.cache[value] = self.parse(value)
+        else:
+            self.hits += 1
+        d[fn] = result
 
 
 class FieldCleaner():
     def __init__(self, field_name, *cleaners, **kwargs):
         extra_fields_to_save = kwargs.get('extra_fields_to_save', None)
+        # Other input columns the cleaners read but that aren't output
+        reads = kwargs.get('reads', ())
+        if isinstance(reads, basestring):
+            reads = (reads,)
         self.field_name = field_name
         self.output_name = field_name
         self.extra_fields_to_save = extra_fields_to_save
+        self.reads = list(reads)
         self.cleaners = list(cleaners)
 
         if '=>' in field_name:
@@ -233,3 +717,66 @@ class FieldCleaner():
             else:
                 cleaner.clean(d, self.field_name)
 
+
+def compile_row_cleaner(fields, output_fields, timings=None, schema=None):
+    """
+    Compile a list of FieldCleaners into a single function that cleans a
+    row and returns a new row containing only output_fields.
+
+    Cleaner dispatch is resolved once here, and a Rename at the end of a
+    field's cleaners becomes part of building the output row rather than
+    a copy inside the input row.
+
+    If timings is a dict, the seconds spent in each cleaner are added to
+    timings[(output_name, cleaner name)].
+
+    If schema is a RowSchema of output_fields, the new rows are
+    CompactRows of that schema instead of dicts.
+    """
+    namespace = {}
+    body = []
+    sources = {}
+    for field in fields:
+        cleaners = list(field.cleaners)
+        while cleaners and isinstance(cleaners[-1], Rename):
+            cleaners.pop()
+            sources[field.output_name] = field.field_name
+        for cleaner in cleaners:
+            if isinstance(cleaner, Rename):
+                args = (field.field_name, field.output_name)
+            else:
+                args = (field.field_name,)
+            name = 'clean%d' % len(namespace)
+            namespace[name] = cleaner.clean
+            if timings is not None:
+                namespace[name] = timed(
+                    cleaner.clean, timings,
+                    (field.output_name, cleaner_name(cleaner)))
+            body.append('    %s(row, %s)' % (name, ', '.join(map(repr, args))))
+
+    projection = [(k, sources.get(k, k)) for k in output_fields]
+    namespace['projection'] = projection
+    if schema is not None:
+        assert schema.fields == list(output_fields), \
+            "Schema does not match the output fields"
+        namespace['CompactRow'] = CompactRow
+        namespace['MISSING'] = MISSING
+        namespace['schema'] = schema
+        body.append('    try:')
+        body.append('        return CompactRow(schema, [%s])' % ', '.join(
+            'row[%r]' % src for k, src in projection))
+        body.append('    except KeyError:')
+        body.append('        return CompactRow(schema, [row.get(src, MISSING) '
+                    'for k, src in projection])')
+    else:
+        body.append('    try:')
+        body.append('        return {%s}' % ', '.join(
+            '%r: row[%r]' % item for item in projection))
+        body.append('    except KeyError:')
+        # Fields missing from the input are left out of the output row
+        body.append('        return {k: row[src] for k, src in projection '
+                    'if src in row}')
+
+    source = 'def clean_row(row):\n' + '\n'.join(body) + '\n'
+    exec source in namespace
+    return namespace['clean_row']
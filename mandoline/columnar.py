@@ -0,0 +1,381 @@
+"""
+A columnar cleaning engine that keeps each field in a NumPy array
+"""
+
+from inspect import getmro
+import itertools
+import os
+
+# numpy is imported when the first ColumnarCleaner is made
+np = None
+
+from aggregators import (Count, DistinctCount, Max, Mean, Min, Sum,
+                         aggregated_fields, as_reducer)
+from cleaners import Date, Float, Int, Lookup, Rename
+from mandoline import MandolineCleaner
+
+__all__ = ['ColumnarCleaner']
+
+
+# Helpers
+
+def _import_numpy():
+    """
+    Import numpy into this module, returning False if it isn't installed
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+
+
+def _to_array(values):
+    """
+    Convert a list of python values to the narrowest sensible array
+    """
+    types = set(type(v) for v in values)
+    if types and types <= set([int, long]):
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            pass
+    elif types == set([float]):
+        return np.array(values, dtype=np.float64)
+    # Strings are kept as objects: a fixed width string array would make
+    # every value as wide as the longest one
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+    return arr
+
+
+def _factorize(values):
+    """
+    Returns (uniques, codes) where uniques[codes] == values
+    """
+    if values.dtype.kind != 'O':
+        return np.unique(values, return_inverse=True)
+    index = {}
+    codes = np.fromiter((index.setdefault(v, len(index)) for v in values),
+                        dtype=np.intp, count=len(values))
+    uniques = np.empty(len(index), dtype=object)
+    for v, code in index.iteritems():
+        uniques[code] = v
+    return uniques, codes
+
+
+def _map_unique(values, fn):
+    """
+    Apply fn once per distinct value in values
+    """
+    uniques, codes = _factorize(values)
+    return _to_array([fn(v) for v in uniques.tolist()])[codes]
+
+
+# Vectorized versions of the built-in cleaners. Each takes the cleaner
+# and a column and returns the cleaned column.
+
+def _lookup_column(cleaner, values):
+    return _map_unique(values, cleaner.lookup_value)
+
+
+def _is_text(values):
+    return values.dtype.kind == 'O' and all(
+        isinstance(v, basestring) for v in values)
+
+
+def _int_column(cleaner, values):
+    if values.dtype.kind in 'iu':
+        return values
+    if _is_text(values):
+        # converts each value with int(), like Int.parse does first
+        try:
+            return values.astype(np.int64)
+        except (OverflowError, ValueError):
+            pass
+
+    def to_int(v):
+        d = {'v': v}
+        cleaner.clean(d, 'v')
+        return d['v']
+
+    return _map_unique(values, to_int)
+
+
+def _float_column(cleaner, values):
+    if values.dtype.kind in 'iuf':
+        return values.astype(np.float64)
+    if (cleaner.thousands is None and cleaner.decimal == '.' and
+            _is_text(values)):
+        try:
+            floats = values.astype(np.float64)
+        except ValueError:
+            pass
+        else:
+            if np.isfinite(floats).all():
+                return floats
+
+    def to_float(v):
+        d = {'v': v}
+        cleaner.clean(d, 'v')
+        return d['v']
+
+    return _map_unique(values, to_float)
+
+
+def _date_column(cleaner, values):
+    return _map_unique(values, cleaner.parse)
+
+
+column_cleaners = {
+    Lookup: _lookup_column,
+    Int: _int_column,
+    Float: _float_column,
+    Date: _date_column,
+}
+
+
+def _column_cleaner(cleaner):
+    for cls in getmro(cleaner.__class__):
+        if cls in column_cleaners:
+            return column_cleaners[cls]
+    return None
+
+
+# Reductions over the groups of a sorted column. Each takes the column
+# sorted by group, the index where each group starts and the group code
+# of each sorted value.
+
+def _group_sizes(values, starts):
+    return np.diff(np.append(starts, len(values)))
+
+
+def _reduce_count(reducer, values, starts, codes):
+    if reducer.field_name is None or values.dtype.kind != 'O':
+        return _group_sizes(values, starts)
+    present = np.fromiter((v is not None for v in values), dtype=np.int64,
+                          count=len(values))
+    return np.add.reduceat(present, starts)
+
+
+def _reduce_distinct(reducer, values, starts, codes):
+    uniques, value_codes = _factorize(values)
+    pairs = np.unique(codes * len(uniques) + value_codes)
+    return np.bincount(pairs // len(uniques), minlength=len(starts))
+
+
+def _reduce_ufunc(name):
+    def reduce_column(reducer, values, starts, codes):
+        return getattr(np, name).reduceat(values, starts)
+    return reduce_column
+
+
+def _reduce_mean(reducer, values, starts, codes):
+    return (np.add.reduceat(values, starts).astype(np.float64) /
+            _group_sizes(values, starts))
+
+
+# Reductions that can be used on columns of any type
+column_reducers = {
+    Sum: _reduce_ufunc('add'),
+    Count: _reduce_count,
+    DistinctCount: _reduce_distinct,
+}
+
+# Reductions that need numeric columns, where there can be no None values
+numeric_column_reducers = {
+    Min: _reduce_ufunc('minimum'),
+    Max: _reduce_ufunc('maximum'),
+    Mean: _reduce_mean,
+}
+
+
+def _reduce_column(reducer, values, starts, codes):
+    reduce_column = column_reducers.get(type(reducer))
+    if reduce_column is None and values.dtype.kind in 'iuf':
+        reduce_column = numeric_column_reducers.get(type(reducer))
+    if reduce_column is not None:
+        return reduce_column(reducer, values, starts, codes)
+
+    # Reduce each group with the reducer itself
+    results = []
+    ends = np.append(starts[1:], len(values))
+    for start, end in itertools.izip(starts, ends):
+        acc = reducer.start()
+        for value in values[start:end].tolist():
+            acc = reducer.add(acc, value)
+        results.append(reducer.result(acc))
+    return _to_array(results)
+
+
+class ColumnarCleaner(MandolineCleaner):
+    """
+    A MandolineCleaner that loads the selected fields into one NumPy array
+    per field and cleans whole columns at a time.
+
+    Lookup, StateAbbrevLookup, Int, Float and Date run once per distinct value
+    or as array operations. Other cleaners fall back to cleaning rows.
+    Columns are turned back into rows only when they are written.
+    """
+
+    def __init__(self):
+        assert _import_numpy(), "ColumnarCleaner needs numpy"
+        MandolineCleaner.__init__(self)
+        self.columns = {}
+
+    # Tests
+
+    def _requires_clean_rows(self):
+        assert self._row_count() > 0
+
+    def _row_count(self):
+        if not self.columns:
+            return 0
+        return len(self.columns.itervalues().next())
+
+    # Helpers
+
+    def _load_columns(self, rows):
+        names = self.input_flds
+        lists = [[] for _ in names]
+        for row in rows:
+            for name, values in itertools.izip(names, lists):
+                values.append(row.get(name))
+        return dict((name, _to_array(values))
+                    for name, values in itertools.izip(names, lists))
+
+    def _rows_from_columns(self, names):
+        lists = [self.columns[name].tolist() for name in names]
+        for values in itertools.izip(*lists):
+            yield dict(itertools.izip(names, values))
+
+    # Clean
+
+    def clean(self):
+        self._requires_files()
+        self.aggregated_fields = None
+        self._generate_field_metadata()
+
+        parts = []
+        for f in self.collection.collection:
+            if f.endswith("xlsx"):
+                rows = self._readxlsx(f)
+            elif f.endswith("csv"):
+                rows = self._readcsv(f)
+            else:
+                continue
+            self.logger.info("Loading columns from " + f)
+            self.input_filename = f
+            with self._stage('load', f) as stage:
+                parts.append(self._load_columns(rows))
+                stage.rows = len(parts[-1][self.input_flds[0]])
+                stage.bytes_read = os.path.getsize(f)
+
+        if len(parts) == 1:
+            self.columns = parts[0]
+        else:
+            self.columns = dict(
+                (name, np.concatenate([part[name] for part in parts]))
+                for name in self.input_flds)
+        with self._stage('clean') as stage:
+            self._cleancolumns()
+            stage.rows = self._row_count()
+        return self
+
+    def _cleancolumns(self):
+        self.logger.info("Cleaning %d rows as columns" % self._row_count())
+        for field in self.fields:
+            for cleaner in field.cleaners:
+                if isinstance(cleaner, Rename):
+                    self.columns[field.output_name] = \
+                        self.columns[field.field_name]
+                    continue
+                column_cleaner = _column_cleaner(cleaner)
+                if column_cleaner is None:
+                    self._cleanrowwise(field, cleaner)
+                else:
+                    self.columns[field.field_name] = column_cleaner(
+                        cleaner, self.columns[field.field_name])
+
+        self.columns = dict((name, self.columns[name]) for name in self.fld_set
+                            if name in self.columns)
+        self.logger.info("Cleaned %d rows" % self._row_count())
+        return self
+
+    def _cleanrowwise(self, field, cleaner):
+        """
+        Clean one field with a cleaner that only works on row dicts
+        """
+        rows = list(self._rows_from_columns(list(self.columns)))
+        for row in rows:
+            cleaner.clean(row, field.field_name)
+        self.columns[field.field_name] = _to_array(
+            [row[field.field_name] for row in rows])
+
+    def process(self, fn):
+        """ Ad hoc processing on rows built from the columns
+        """
+        self._generate_field_metadata()
+        self.rows = list(self._rows_from_columns(list(self.columns)))
+        MandolineCleaner.process(self, fn)
+        self.columns = dict(
+            (name, _to_array([row.get(name) for row in self.rows]))
+            for name in self.columns)
+        self.rows = []
+        return self
+
+    def aggregate(self, *reducers, **kwargs):
+        """
+        Group rows by every field that isn't reduced, using a sort of the
+        group codes and reductions over each group's slice of the column
+
+        max_groups and spill_dir are accepted so the same call works with
+        MandolineCleaner, but nothing is spilled: the columns are already
+        in memory and each group only adds an entry to the result columns.
+        """
+        self._requires_clean_rows()
+
+        self.logger.info(
+            "Aggregating, initial row count is %d" % (self._row_count()))
+        reducers = [as_reducer(r) for r in reducers]
+        key_fields, output_fields = aggregated_fields(self.flds, reducers)
+
+        codes = np.zeros(self._row_count(), dtype=np.intp)
+        for f in key_fields:
+            uniques, inverse = _factorize(self.columns[f])
+            # renumber the combined codes so they never overflow
+            codes = np.unique(codes * len(uniques) + inverse,
+                              return_inverse=True)[1]
+
+        order = np.argsort(codes, kind='mergesort')
+        sorted_codes = codes[order]
+        starts = np.concatenate(
+            ([0], np.flatnonzero(sorted_codes[1:] != sorted_codes[:-1]) + 1))
+
+        columns = {}
+        for f in key_fields:
+            columns[f] = self.columns[f][order[starts]]
+        for r in reducers:
+            if r.field_name is None:
+                values = np.ones(len(order), dtype=np.int64)
+            else:
+                values = self.columns[r.field_name][order]
+            columns[r.output_name] = _reduce_column(r, values, starts,
+                                                    sorted_codes)
+        self.columns = columns
+        self.aggregated_fields = output_fields
+        self.flds = output_fields
+        self.fld_set = set(output_fields)
+
+        self.logger.info(
+            "Aggregating, after aggregation row count is %d" % (self._row_count()))
+        return self
+
+    # Outputs
+
+    def _output_rows(self):
+        return self._rows_from_columns(
+            [name for name in self.flds if name in self.columns])
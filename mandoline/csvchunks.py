@@ -0,0 +1,96 @@
+"""
+Splits a csv file into byte ranges that start and end on record
+boundaries, so the ranges can be parsed independently
+"""
+
+import mmap
+import os
+
+# How much of the file is scanned for quotes at a time
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _count_quotes(mm, start, end):
+    count = 0
+    while start < end:
+        stop = min(end, start + SCAN_BLOCK_SIZE)
+        count += mm[start:stop].count('"')
+        start = stop
+    return count
+
+
+def _line_terminator(mm):
+    """
+    The character that ends records: '\r' if the first line ends with a
+    bare carriage return, like in files written by old Mac programs, and
+    otherwise '\n' (which also ends '\r\n' lines)
+    """
+    newline = mm.find('\n')
+    if newline == -1:
+        newline = len(mm)
+    cr = mm.find('\r', 0, newline)
+    if cr != -1 and cr + 1 < len(mm) and mm[cr + 1] != '\n':
+        return '\r'
+    return '\n'
+
+
+def _record_end(mm, pos, quoted, terminator='\n'):
+    """
+    The offset just past the first terminator at or after pos that isn't
+    inside quotes. quoted says whether pos is inside quotes.
+    """
+    while True:
+        newline = mm.find(terminator, pos)
+        if newline == -1:
+            return len(mm)
+        if _count_quotes(mm, pos, newline) % 2:
+            quoted = not quoted
+        if not quoted:
+            return newline + 1
+        pos = newline + 1
+
+
+def record_ranges(path, chunk_size):
+    """
+    Returns [(start, end)] byte ranges covering every record of a csv file
+    after its header, each about chunk_size bytes.
+
+    Quotes are counted from the start of the file, so newlines inside
+    quoted values never split a record. Doubled quotes inside a quoted
+    value cancel out. Records end with '\n' or '\r\n', or with a bare '\r'
+    if that's how the header ends, the line endings reading with 'rU'
+    understands.
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            terminator = _line_terminator(mm)
+            start = _record_end(mm, 0, False, terminator)
+            ranges = []
+            while start < size:
+                target = start + chunk_size
+                if target >= size:
+                    ranges.append((start, size))
+                    break
+                quoted = _count_quotes(mm, start, target) % 2 == 1
+                end = _record_end(mm, target, quoted, terminator)
+                ranges.append((start, end))
+                start = end
+            return ranges
+        finally:
+            mm.close()
+
+
+def read_range(path, start, end):
+    """
+    The bytes of path from start to end
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mm[start:end]
+        finally:
+            mm.close()
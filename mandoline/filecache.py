@@ -0,0 +1,210 @@
+"""
+An on-disk cache of cleaned rows, so files that haven't changed since the
+last run don't have to be loaded and cleaned again.
+"""
+
+import cPickle
+import hashlib
+import json
+import logging
+import os
+import re
+import types
+
+from cleaners import LRUCache, ValueCache
+
+logger = logging.getLogger("mandoline.filecache")
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# Part of every fingerprint. Change it when the built-in cleaners change
+# what they produce, so rows cleaned by an older mandoline aren't reused.
+CACHE_VERSION = 2
+
+_pattern_type = type(re.compile(''))
+
+
+def file_hash(fn):
+    """
+    The sha1 of a file's contents
+    """
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        while True:
+            data = f.read(HASH_BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def _code_names(code):
+    """
+    The global names used by a code object and the functions defined in it
+    """
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+def _describe_code(code, seen):
+    return 'code %s %s' % (code.co_code.encode('hex'),
+                           _describe(code.co_consts, seen))
+
+
+def _describe(obj, seen):
+    """
+    A string describing obj that doesn't change between runs. Raises
+    ValueError for objects that can't be described that way.
+    """
+    if obj is None or isinstance(obj, (basestring, bool, int, long, float)):
+        return repr(obj)
+    if isinstance(obj, (LRUCache, ValueCache)):
+        return obj.__class__.__name__
+    if isinstance(obj, types.ModuleType):
+        return 'module %s' % obj.__name__
+    if isinstance(obj, (type, types.ClassType)):
+        return 'class %s.%s' % (obj.__module__, obj.__name__)
+    if isinstance(obj, types.BuiltinFunctionType):
+        return 'builtin %s' % obj.__name__
+    if isinstance(obj, _pattern_type):
+        return 'pattern %r %d' % (obj.pattern, obj.flags)
+    if isinstance(obj, types.CodeType):
+        return _describe_code(obj, seen)
+    if id(obj) in seen:
+        return 'cycle'
+    seen = seen | set([id(obj)])
+    if isinstance(obj, types.MethodType):
+        return 'method %s of %s' % (_describe(obj.im_func, seen),
+                                    _describe(obj.im_self, seen))
+    if isinstance(obj, types.FunctionType):
+        # what a function does depends on its code, the values it closes
+        # over, its default arguments and the globals it uses
+        code = obj.func_code
+        cells = []
+        for cell in obj.func_closure or ():
+            try:
+                cells.append(cell.cell_contents)
+            except ValueError:
+                cells.append('empty cell')
+        used = dict((name, obj.func_globals[name])
+                    for name in _code_names(code)
+                    if name in obj.func_globals)
+        return 'function %s.%s %s %s %s %s' % (
+            obj.__module__, obj.__name__, _describe_code(code, seen),
+            _describe(cells, seen), _describe(obj.func_defaults, seen),
+            _describe(used, seen))
+    if isinstance(obj, dict):
+        return '{%s}' % ','.join(sorted(
+            '%s:%s' % (_describe(k, seen), _describe(v, seen))
+            for k, v in obj.iteritems()))
+    if isinstance(obj, (set, frozenset)):
+        return 'set(%s)' % ','.join(sorted(_describe(v, seen) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return '[%s]' % ','.join(_describe(v, seen) for v in obj)
+    if hasattr(obj, '__dict__'):
+        # private attributes are caches and indexes built from the others
+        cls = obj.__class__
+        public = dict((k, v) for k, v in vars(obj).iteritems()
+                      if not k.startswith('_'))
+        return '%s.%s%s' % (cls.__module__, cls.__name__,
+                            _describe(public, seen))
+    description = repr(obj)
+    if ' at 0x' in description:
+        raise ValueError("Can not describe " + description)
+    return description
+
+
+def fields_fingerprint(fields):
+    """
+    A hash of the FieldCleaners given to set_fields, or None if they use
+    something that can't be described the same way in every run.
+    Cleaning functions are described by their code and the values they
+    use, so editing one or changing what it closes over changes the
+    fingerprint.
+    """
+    try:
+        description = _describe(list(fields), set())
+    except ValueError as e:
+        logger.warning("Can not fingerprint the fields: %s" % e)
+        return None
+    return hashlib.sha1('%d %s' % (CACHE_VERSION, description)).hexdigest()
+
+
+class CleanCache(object):
+    """
+    Stores the cleaned rows of each file in cache_dir, with a manifest
+    of the size, mtime and content hash of the file they came from and
+    the fingerprint of the fields they were cleaned with.
+
+    A file whose size and mtime haven't changed is trusted to be the
+    same. Otherwise its contents are hashed, so files that were only
+    touched or copied are still reused.
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, cache_dir, fingerprint):
+        self.cache_dir = cache_dir
+        self.fingerprint = fingerprint
+        self.manifest_path = os.path.join(cache_dir, self.manifest_name)
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def _rows_path(self, fn):
+        name = hashlib.sha1(os.path.abspath(fn)).hexdigest()
+        return os.path.join(self.cache_dir, name + '.pickle')
+
+    def get(self, fn):
+        """
+        Returns the cached rows for fn, or None if it must be cleaned
+        """
+        entry = self.manifest.get(os.path.abspath(fn))
+        rows_path = self._rows_path(fn)
+        if (entry is None or entry['fingerprint'] != self.fingerprint or
+                not os.path.exists(rows_path)):
+            self.misses += 1
+            return None
+
+        st = os.stat(fn)
+        if entry['size'] != st.st_size:
+            self.misses += 1
+            return None
+        if entry['mtime'] != st.st_mtime:
+            if entry['sha1'] != file_hash(fn):
+                self.misses += 1
+                return None
+            entry['mtime'] = st.st_mtime
+
+        self.hits += 1
+        with open(rows_path, 'rb') as f:
+            return cPickle.load(f)
+
+    def put(self, fn, rows):
+        st = os.stat(fn)
+        rows_path = self._rows_path(fn)
+        with open(rows_path + '.tmp', 'wb') as f:
+            cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(rows_path + '.tmp', rows_path)
+        self.manifest[os.path.abspath(fn)] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'sha1': file_hash(fn),
+            'fingerprint': self.fingerprint,
+        }
+
+    def save(self):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+        logger.info("Reused %d cleaned files, cleaned %d" % (self.hits,
+                                                             self.misses))
@@ -1,42 +1,132 @@
 from collections import Iterable
+from contextlib import contextmanager
+import cStringIO
 import logging
 import itertools
 import json
 import os
+import shutil
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 
-from requests import get as http_get, put as http_put, delete as http_delete
-from boto.s3.connection import S3Connection
-
+from aggregators import *
 from cleaners import *
+from csvchunks import read_range, record_ranges
+from filecache import CleanCache, fields_fingerprint
+from metrics import RunReport, Stage, peak_memory_kb
+from ratelimit import host_rate_limiter
+from rows import CompactRow, RowSchema
+from schema import infer_schema
+from slicecache import SliceboardCache
+from s3upload import S3Uploader, get_bucket, get_connection
+
 
+# Nothing is logged until logging is configured, by the application or
+# with configure_logging()
+logging.getLogger('mandoline').addHandler(logging.NullHandler())
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s',
-                    filename='mandoline.log')
 
-# define a Handler which writes INFO messages or higher to the sys.stderr
-console = logging.StreamHandler()
-console.setLevel(logging.DEBUG)
-# set a format which is simpler for console use
-formatter = logging.Formatter('%(levelname)-8s %(message)s')
-# tell the handler to use this format
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger('mandoline').addHandler(console)
+def configure_logging(level=logging.DEBUG, filename='mandoline.log',
+                      console=True):
+    """
+    Log everything to filename and, if console, mandoline's messages to
+    stderr as well
+    """
+    logging.basicConfig(level=level,
+                        format='%(asctime)s %(name)-20s %(levelname)-8s %(message)s',
+                        filename=filename)
+
+    if console:
+        # define a Handler which writes messages to the sys.stderr
+        handler = logging.StreamHandler()
+        handler.setLevel(level)
+        # set a format which is simpler for console use
+        handler.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+        logging.getLogger('mandoline').addHandler(handler)
 
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', None)
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', None)
 
+# Set S3_HOST (and S3_PORT) to use an S3-compatible server instead of AWS
+S3_HOST = os.environ.get('S3_HOST', None)
+S3_PORT = int(os.environ['S3_PORT']) if os.environ.get('S3_PORT') else None
+S3_SECURE = os.environ.get('S3_SECURE', 'true').lower() != 'false'
+
+ROWS_CACHE_BUCKET = 'slice-rows-cache'
+
+# Chunk size used when copying whole files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Number of threads used to validate files
+VALIDATION_WORKERS = 8
+
+# When cleaning with workers, csv files bigger than this are split into
+# chunks of about this size that are cleaned in parallel
+CSV_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Settings for the connections MandolineSlice makes to slice
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_POOL_SIZE = 10
+
+# Seconds a fetched sliceboard is used before asking slice if it changed
+SLICEBOARD_CACHE_TTL = 60
+
+# The cleaner being run by a worker pool. Workers are forked from the
+# parent, so they inherit it (and any unpicklable cleaning functions)
+# without it being pickled.
+_pool_cleaner = None
+
+
+def _pool_clean(job):
+    f, start, end = job
+    if start is None:
+        return _pool_cleaner._cleanfile(f)
+    return _pool_cleaner._cleanchunk(f, start, end)
+
+
+def _xlsx_value(value):
+    """
+    Make lazily read booleans match the 1 and 0 a fully loaded workbook
+    gives. Numbers are left as floats: a fully loaded workbook has an int
+    for a cell saved as "3" and a float for "3.0", but lazily read cells
+    are floats by the time they get here.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
 
 class FileCollection(object):
-    def __init__(self, pattern, validators=[]):
+    def __init__(self, pattern, validators=[], workers=VALIDATION_WORKERS):
+        """
+        Match files with a glob pattern and check them with validators
+
+        Files are validated concurrently in a pool of worker threads.
+        """
         from glob import glob
 
-        self.collection = glob(pattern)
+        self.collection = sorted(glob(pattern))
         if validators:
+            self.validate(validators, workers)
+
+    def validate(self, validators, workers=VALIDATION_WORKERS):
+        def validate_file(f):
             for file_validator in validators:
-                for f in self.collection:
-                    file_validator.test(f)
+                file_validator.test(f)
+
+        if workers > 1 and len(self.collection) > 1:
+            pool = ThreadPool(min(workers, len(self.collection)))
+            try:
+                pool.map(validate_file, self.collection)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for f in self.collection:
+                validate_file(f)
 
     @property
     def length(self):
@@ -48,13 +138,33 @@ class MandolineCleaner():
     Contains a list of FieldCleaners
     """
 
-    def __init__(self):
+    def __init__(self, compact_rows=False):
+        """
+        @param compact_rows: If True, loaded and cleaned rows are kept as
+            CompactRows, which share one list of field names instead of
+            each being a dict. They use much less memory but fields are
+            slower to read and write.
+        """
         self.fields = []
         self.logger = logging.getLogger("mandoline")
         self.rows = []
         self.inputrows = []
         self.input_filename = None
         self.output_filename = None
+        self.streaming = False
+        # Set once streamed rows start being read, as they can't be again
+        self.stream_read = False
+        self.report = RunReport()
+        self.hooks = []
+        self.profile_stages = False
+        self.time_cleaners = False
+        self.schema = None
+        self.compact_rows = compact_rows
+        self.row_schema = None
+        # Names fields are written under, from refine_fieldnames
+        self.output_names = {}
+        # The fields of aggregated rows, which replace those of set_fields
+        self.aggregated_fields = None
 
 
     # Tests
@@ -73,7 +183,15 @@ class MandolineCleaner():
         assert not self.cleaner is None, "Needs cleaner"
 
     def _requires_clean_rows(self):
-        assert self.rows and len(self.rows) > 0
+        if self.streaming:
+            assert self.rows is not None, "Needs clean()"
+        else:
+            assert self.rows and len(self.rows) > 0
+
+    def _requires_unread_rows(self):
+        self._requires_clean_rows()
+        assert not (self.streaming and self.stream_read), \
+            "Streamed rows were already written, clean(stream=True) again"
 
     def _requires_loaded_data(self):
         assert self.inputrows and len(self.inputrows) > 0
@@ -91,7 +209,71 @@ class MandolineCleaner():
                     flds.append(f)
 
         self.flds = flds
-        self.fld_set = set(flds)
+        if self.aggregated_fields is not None:
+            self.flds = self.aggregated_fields
+        self.fld_set = set(self.flds)
+
+        # Fields that are read from the input files
+        output_names = set(fld.output_name for fld in self.fields)
+        self.input_flds = [fld.field_name for fld in self.fields]
+        self.input_flds.extend(f for f in flds if f not in output_names)
+        for fld in self.fields:
+            self.input_flds.extend(f for f in fld.reads
+                                   if f not in self.input_flds)
+        self.input_fld_set = set(self.input_flds)
+        timings = self.report.cleaner_seconds if self.time_cleaners else None
+        # The fields and their order of compact cleaned rows
+        self.row_schema = RowSchema(flds) if self.compact_rows else None
+        self.row_cleaner = compile_row_cleaner(self.fields, flds, timings,
+                                               self.row_schema)
+
+    @contextmanager
+    def _stage(self, name, detail=None):
+        """
+        Time a stage of the run and add it to self.report, profiling it
+        if profile_stages is set. Hooks are called with the finished Stage.
+        """
+        stage = Stage(name, detail)
+        profiler = None
+        if self.profile_stages:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            yield stage
+        except Exception as e:
+            stage.error = repr(e)
+            raise
+        finally:
+            stage.seconds = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                stage.profile = profiler
+            stage.peak_memory_kb = peak_memory_kb()
+            self.report.stages.append(stage)
+            for hook in self.hooks:
+                hook(stage)
+
+    # Metrics
+
+    def instrument(self, hook=None, profile=False, time_cleaners=False):
+        """
+        Control what is recorded in self.report
+
+        @param hook: A function called with each Stage as it finishes
+        @param profile: If True, run cProfile over every stage. The
+            profile of a stage is printed by stage.profile_text()
+        @param time_cleaners: If True, record the time spent in every
+            cleaner of every field. This slows cleaning down a little.
+        """
+        if hook is not None:
+            self.hooks.append(hook)
+        self.profile_stages = profile
+        self.time_cleaners = time_cleaners
+        if self.fields:
+            self._generate_field_metadata()
+        return self
 
     # File loaders
 
@@ -103,23 +285,225 @@ class MandolineCleaner():
         self.logger.info("Matched %d files" % self.collection.length)
         return self
 
+    def infer_fields(self, sample_size=1000, **kwargs):
+        """
+        Infer the type of every column from the first sample_size rows of
+        the first matched file, and set_fields with cleaners that convert
+        int, float and date columns. Values that don't parse become None.
+
+        What was inferred is kept in self.schema and printed by
+        show_schema(). The separators of numbers are worked out for each
+        column. kwargs are passed to infer_column, for instance
+        infer_fields(thousands=".", decimal=",") to always read numbers
+        the European way.
+        """
+        self._requires_files()
+        f = self.collection.collection[0]
+        header = [name for name in self._readheader(f) if name is not None]
+        if f.endswith("xlsx"):
+            rows = self._readxlsx(f, set(header))
+        else:
+            rows = self._readcsv(f, set(header))
+        self.schema = infer_schema(itertools.islice(rows, sample_size),
+                                   header, **kwargs)
+        for column in self.schema:
+            self.logger.info("Inferred %r" % column)
+        return self.set_fields(*[column.field() for column in self.schema])
+
+    def show_schema(self):
+        for column in self.schema:
+            description = column.type
+            if column.format:
+                description += " " + column.format
+            print "{0:<30} {1:<20} {2} empty, {3} distinct of {4}".format(
+                column.name, description, column.empty, column.distinct,
+                column.sampled)
+        return self
+
     def set_fields(self, *fields):
         self.logger.info("Going to output %d fields" % (len(fields)))
         self.fields = list(fields)
+        self.aggregated_fields = None
+        self._generate_field_metadata()
         return self
 
-    def clean(self):
+    def clean(self, stream=False, workers=None, cache_dir=None,
+              chunk_size=CSV_CHUNK_SIZE):
+        """
+        Load and clean the matched files. Cleaned rows from every file are
+        kept in self.rows, in the sorted order of the file names.
+
+        @param stream: If True, rows are not held in memory. Instead
+            self.rows becomes a generator that reads, cleans and hands
+            rows to the output one at a time. Streamed rows can only be
+            written once.
+        @param workers: If set, load and clean files in a pool of this
+            many processes. csv files bigger than chunk_size are split
+            into chunks on record boundaries, which are cleaned in
+            parallel and put back together in order.
+        @param cache_dir: If set, the cleaned rows of each file are kept
+            in this directory. Files that haven't changed since they were
+            cleaned with the same set_fields are not cleaned again. If a
+            cleaning function uses a value that can't be fingerprinted,
+            the cache isn't used.
+        """
         self._requires_files()
+        assert not (stream and workers), "Can not stream with workers"
+        assert not (stream and cache_dir), "Can not stream with a cache"
+        self.streaming = stream
+        self.stream_read = False
+        self.aggregated_fields = None
+
+        if stream:
+            self._generate_field_metadata()
+            self.input_filename = self.collection.collection[0]
+            self.rows = self._streamrows()
+            return self
+
+        cache = None
+        if cache_dir:
+            fingerprint = fields_fingerprint(self.fields)
+            if fingerprint is None:
+                self.logger.warning("Cleaning without the cache, the fields "
+                                    "can not be fingerprinted")
+            else:
+                cache = CleanCache(cache_dir, fingerprint)
+
+        rows = []
+        for f, file_rows in self._cleanfiles(workers, cache, chunk_size):
+            rows.extend(file_rows)
+        if cache:
+            cache.save()
 
+        self.rows = rows
+        return self
+
+    def _jobs(self, f, chunk_size=None):
+        """
+        The (filename, start, end) jobs that clean a file in a worker pool.
+        Big csv files are split into byte ranges, others are one job with
+        no range. So are files whose ranges don't reach the end of the
+        file, to never drop records that weren't split correctly.
+        """
+        if (chunk_size and f.endswith("csv") and
+                os.path.getsize(f) > chunk_size):
+            ranges = record_ranges(f, chunk_size)
+            if ranges and ranges[-1][1] == os.path.getsize(f):
+                return [(f, start, end) for start, end in ranges]
+        return [(f, None, None)]
+
+    def _cleanfiles(self, workers=None, cache=None, chunk_size=None):
+        """
+        Generate (filename, cleaned rows) for every matched file, in order.
+        Rows are taken from the cache when they can be, and the remaining
+        files are cleaned here or in a pool of workers.
+        """
+        global _pool_cleaner
+        files = self.collection.collection
+        cached = {}
+        if cache:
+            for f in files:
+                file_rows = cache.get(f)
+                if file_rows is not None:
+                    cached[f] = file_rows
+        todo = [f for f in files if f not in cached]
+
+        pool = None
+        if workers and todo:
+            self._generate_field_metadata()
+            jobs = []
+            job_counts = {}
+            for f in todo:
+                file_jobs = self._jobs(f, chunk_size)
+                job_counts[f] = len(file_jobs)
+                jobs.extend(file_jobs)
+            self.logger.info("Processing %d jobs with %d workers" % (
+                len(jobs), workers))
+            _pool_cleaner = self
+            pool = Pool(workers)
+            cleaned = pool.imap(_pool_clean, jobs)
+        else:
+            cleaned = itertools.imap(self._cleanfile, todo)
+
+        finished = False
+        try:
+            for f in files:
+                if f in cached:
+                    self.logger.info("Reusing cleaned rows for " + f)
+                    with self._stage('cached', f) as stage:
+                        file_rows = cached[f]
+                        stage.rows = len(file_rows)
+                elif pool is not None:
+                    self.logger.info("Processing " + f)
+                    with self._stage('worker', f) as stage:
+                        parts = [cleaned.next() for _ in
+                                 range(job_counts[f])]
+                        if len(parts) == 1:
+                            file_rows = parts[0]
+                        else:
+                            file_rows = list(
+                                itertools.chain.from_iterable(parts))
+                        stage.rows = len(file_rows)
+                        stage.bytes_read = os.path.getsize(f)
+                else:
+                    self.logger.info("Processing " + f)
+                    file_rows = cleaned.next()
+                if f not in cached and cache:
+                    cache.put(f, file_rows)
+                self.input_filename = f
+                yield f, file_rows
+            finished = True
+        finally:
+            if pool is not None:
+                if finished:
+                    pool.close()
+                else:
+                    # don't wait for the remaining jobs after an error
+                    pool.terminate()
+                pool.join()
+                _pool_cleaner = None
+
+    def _cleanfile(self, f):
+        """
+        Load and clean a single file, returning the cleaned rows
+        """
+        if f.endswith("xlsx"):
+            self.loadxlsx(f)
+        elif f.endswith("csv"):
+            self.loadcsv(f)
+        else:
+            return []
+        self._cleanrows()
+        return self.rows
+
+    def _cleanchunk(self, f, start, end):
+        """
+        Load and clean the records of a csv file between two byte offsets
+        """
+        return list(self._itercleanrows(self._readcsv(f, start=start,
+                                                      end=end)))
+
+    def _streamrows(self):
+        """
+        Lazily load and clean every matched file
+        """
+        self.stream_read = True
         for f in self.collection.collection:
-            self.logger.info("Processing " + f)
             if f.endswith("xlsx"):
-                self.loadxlsx(f)
-                self._cleanrows()
-            if f.endswith("csv"):
-                self.loadcsv(f)
-                self._cleanrows()
-        return self
+                rows = self._readxlsx(f)
+            elif f.endswith("csv"):
+                rows = self._readcsv(f)
+            else:
+                continue
+            self.logger.info("Streaming " + f)
+            self.input_filename = f
+            # The stage includes the time the rows take to be written
+            with self._stage('stream', f) as stage:
+                stage.bytes_read = os.path.getsize(f)
+                stage.rows = 0
+                for row in self._itercleanrows(rows):
+                    stage.rows += 1
+                    yield row
 
     def loadxlsx(self, f):
         """
@@ -131,60 +515,178 @@ class MandolineCleaner():
         self._generate_field_metadata()
         self.input_filename = f
 
-        from openpyxl import load_workbook
-
         self.logger.info("Loading as xlsx")
-        wb = load_workbook(self.input_filename)
-        sht = wb.get_sheet_by_name(wb.get_sheet_names()[0])
-        header = sht.rows[0]
-        rows = sht.rows[1:]
-
-        self.inputrows = [dict(
-            zip(map(lambda r: r.value, header), map(lambda r: r.value, row)))
-                          for row in rows]
+        with self._stage('load', f) as stage:
+            self.inputrows = list(self._readxlsx(f))
+            stage.rows = len(self.inputrows)
+            stage.bytes_read = os.path.getsize(f)
         self.logger.info("Found %d rows" % len(self.inputrows))
         return self
 
     def loadcsv(self, f):
         """
+        Take a csv file as an input to the cleaner.
 
+        @param f: A file
+        @return:
         """
         self._generate_field_metadata()
         self.input_filename = f
 
-        reader = csv.DictReader(open(self.input_filename, 'rU'))
-        self.inputrows = list(reader)
+        with self._stage('load', f) as stage:
+            self.inputrows = list(self._readcsv(f))
+            stage.rows = len(self.inputrows)
+            stage.bytes_read = os.path.getsize(f)
         return self
 
+    def _input_columns(self, header, names=None):
+        """
+        Returns (index, name) for the header columns that are read from
+        the input: names, or by default the fields in set_fields, their
+        extra_fields_to_save and the columns they read.
+        """
+        if names is None:
+            names = self.input_fld_set
+        return [(idx, name) for idx, name in enumerate(header)
+                if name is not None and name in names]
+
+    def _readheader(self, f):
+        """
+        The column names in the first row of a file
+        """
+        if f.endswith("xlsx"):
+            from openpyxl import load_workbook
+            wb = load_workbook(f, use_iterators=True)
+            sht = wb.get_sheet_by_name(wb.get_sheet_names()[0])
+            return [cell.internal_value for cell in next(sht.iter_rows(), ())]
+        with open(f, 'rU') as inf:
+            return next(csv.reader(inf), [])
+
+    def _readxlsx(self, f, names=None):
+        """
+        Generate dict rows (or CompactRows) from the first sheet of an
+        excel file
+
+        The sheet is parsed lazily, one row at a time, and only cells
+        between the first and last column named in set_fields (or names)
+        are read.
+        """
+        from openpyxl import load_workbook
+        from openpyxl.cell import get_column_letter
+
+        wb = load_workbook(f, use_iterators=True)
+        sht = wb.get_sheet_by_name(wb.get_sheet_names()[0])
+        header = [cell.internal_value for cell in next(sht.iter_rows())]
+        columns = self._input_columns(header, names)
+        if not columns:
+            return
+
+        first, last = columns[0][0], columns[-1][0]
+        # openpyxl treats the end column of a range as exclusive
+        range_string = "{0}2:{1}{2}".format(get_column_letter(first + 1),
+                                            get_column_letter(last + 2),
+                                            sht.get_highest_row())
+        columns = [(idx - first, name) for idx, name in columns]
+        schema = None
+        if self.compact_rows:
+            schema = RowSchema(name for _, name in columns)
+        for row in sht.iter_rows(range_string):
+            if schema is None:
+                yield dict((name, _xlsx_value(row[idx].internal_value))
+                           for idx, name in columns)
+            else:
+                yield CompactRow(schema, [_xlsx_value(row[idx].internal_value)
+                                          for idx, _ in columns])
+
+    def _readcsv(self, f, names=None, start=None, end=None):
+        """
+        Generate dict rows (or CompactRows) from a csv file, keeping only
+        the columns named in set_fields (or names)
+
+        If start and end are given, only the records between those byte
+        offsets are read. They must be on record boundaries.
+        """
+        with open(f, 'rU') as inf:
+            reader = csv.reader(inf)
+            header = next(reader, None)
+            if header is None:
+                return
+            if start is not None:
+                # translate newlines the way reading with 'rU' does
+                data = read_range(f, start, end)
+                data = data.replace('\r\n', '\n').replace('\r', '\n')
+                reader = csv.reader(cStringIO.StringIO(data))
+            columns = self._input_columns(header, names)
+            if not columns:
+                return
+            indexes = [idx for idx, _ in columns]
+            names = [name for _, name in columns]
+            width = indexes[-1] + 1
+            if len(indexes) == 1:
+                pick = lambda row: (row[indexes[0]],)
+            else:
+                pick = itemgetter(*indexes)
+            schema = RowSchema(names) if self.compact_rows else None
+
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < width:
+                    # short rows are padded with None, like csv.DictReader
+                    row.extend([None] * (width - len(row)))
+                if schema is None:
+                    yield dict(itertools.izip(names, pick(row)))
+                else:
+                    yield CompactRow(schema, list(pick(row)))
+
     # Clean
 
     def _cleanrows(self):
         """
         Perform field cleaning on rows
         """
+        self.aggregated_fields = None
         self._generate_field_metadata()
 
-        self.rows = []
         self.logger.info("Cleaning rows")
-
-        for row in self.inputrows:
-            for field in self.fields:
-                field.clean(row)
-                # delete excess keys
-            for k in list(row.keys()):
-                if k not in self.fld_set:
-                    del row[k]
-            self.rows.append(row)
+        with self._stage('clean', self.input_filename) as stage:
+            self.rows = list(self._itercleanrows(self.inputrows))
+            stage.rows = len(self.rows)
 
         self.logger.info("Cleaned %d rows" % (len(self.rows)))
         return self
 
+    def _itercleanrows(self, rows):
+        """
+        Generate cleaned rows, keeping only the fields in fld_set
+        """
+        return itertools.imap(self.row_cleaner, rows)
+
 
     def drop_field(self, fields_to_drop):
+        """
+        Leave fields out of the output. A field can be named by its input
+        name, its output name or the name refine_fieldnames gave it.
+
+        Rows that are already cleaned are not copied: the dropped fields
+        are left out as the rows are written.
+        """
         if isinstance(fields_to_drop, basestring):
             fields_to_drop = (fields_to_drop,)
         self.logger.info("Dropping field " + str(fields_to_drop))
-        self.fields = [fld for fld in self.fields if fld.field_name not in fields_to_drop]
+        dropped = set(fields_to_drop)
+        fields = []
+        for fld in self.fields:
+            if dropped.intersection((fld.field_name, fld.output_name,
+                                     self.output_names.get(fld.output_name))):
+                dropped.add(fld.output_name)
+            else:
+                fields.append(fld)
+        self.fields = fields
+        if self.aggregated_fields is not None:
+            self.aggregated_fields = [
+                f for f in self.aggregated_fields
+                if f not in dropped and self.output_names.get(f) not in dropped]
         self._generate_field_metadata()
         return self
 
@@ -196,60 +698,112 @@ class MandolineCleaner():
         self.logger.info(
             "Processing, performing arbitrary actions on the clean rows")
         self._generate_field_metadata()
-        fn(self)
+        with self._stage('process', getattr(fn, '__name__', None)):
+            fn(self)
         return self
 
 
-    def aggregate(self, *sum_fields):
-        self._requires_clean_rows()
+    def aggregate(self, *reducers, **kwargs):
+        """
+        Group rows by every field that isn't reduced, in a single pass
 
-        self.logger.info(
-            "Aggregating, initial row count is %d" % (len(self.rows)))
-        self._generate_field_metadata()
-        key_fields = [f for f in self.flds if f not in sum_fields]
-        aggr_fields = [f for f in self.flds if f in sum_fields]
-
-        d = {}
-        for row in self.rows:
-            key = tuple(row[k] for k in key_fields)
-            if key not in d:
-                d[key] = [0 for f in aggr_fields]
-            v = d[key]
-            for idx, f in enumerate(aggr_fields):
-                v[idx] += row[f]
+        Each reducer is a Sum, Count, Min, Max, Mean or DistinctCount, or
+        the name of a field to sum.
 
-        self.rows = []
-        for keys in d.keys():
-            row = dict(itertools.izip(key_fields, keys))
-            row.update(dict(itertools.izip(aggr_fields, d[keys])))
-            self.rows.append(row)
+        @param max_groups: If there are more groups than this, spill them
+            to disk and merge them one partition at a time as the rows
+            are written. The rows can then only be written once.
+        @param spill_dir: Where to put spilled groups, defaults to the
+            system temporary directory.
+        """
+        self._requires_unread_rows()
 
-        self.logger.info(
-            "Aggregating, after aggregation row count is %d" % (len(self.rows)))
+        if self.streaming:
+            self.logger.info("Aggregating streamed rows")
+        else:
+            self.logger.info(
+                "Aggregating, initial row count is %d" % (len(self.rows)))
+        self._generate_field_metadata()
+        reducers = [as_reducer(r) for r in reducers]
+        key_fields, output_fields = aggregated_fields(self.flds, reducers)
+
+        aggregator = HashAggregator(key_fields, reducers,
+                                    max_groups=kwargs.get('max_groups'),
+                                    spill_dir=kwargs.get('spill_dir'))
+        with self._stage('aggregate') as stage:
+            rows = aggregator.aggregate(self.rows)
+            if isinstance(rows, list):
+                stage.rows = len(rows)
+        self.aggregated_fields = output_fields
+        self.flds = output_fields
+        self.fld_set = set(output_fields)
+
+        if isinstance(rows, list):
+            # Aggregated rows are in memory and can be written any number
+            # of times
+            self.rows = rows
+            self.streaming = False
+            self.logger.info(
+                "Aggregating, after aggregation row count is %d" % len(rows))
+        else:
+            # Spilled groups are merged while the rows are written, once
+            self.rows = self._spilledrows(rows)
+            self.streaming = True
+            self.stream_read = False
+            self.logger.info("Aggregated rows will be merged as they are "
+                             "written")
         return self
 
+    def _spilledrows(self, rows):
+        """
+        Generate the rows of an aggregate that spilled to disk
+        """
+        self.stream_read = True
+        for row in rows:
+            yield row
+
     # Outputs
 
+    def _output_rows(self):
+        """
+        The rows to write, as a list or an iterator of dicts or CompactRows
+        """
+        return self.rows
+
+    def _output_names(self):
+        """
+        The names self.flds are written under
+        """
+        return [self.output_names.get(k, k) for k in self.flds]
+
     def to_csv(self, fn=None):
-        self._requires_clean_rows()
+        self._requires_unread_rows()
 
         if fn is None:
             self.output_filename = self.input_filename + '.clean'
         else:
             self.output_filename = fn
 
-        writer = DictUnicodeWriter(open(self.output_filename, 'w'), self.flds,
-                                   extrasaction='ignore')
-
-        writer.writeheader()
-        for row in self.rows:
-            writer.writerow(row)
+        with self._stage('to_csv', self.output_filename) as stage:
+            with open(self.output_filename, 'wb') as outf:
+                writer = BufferedDictUnicodeWriter(outf, self.flds)
+                writer.writeheader(self._output_names())
+                writer.writerows(self._output_rows())
+            stage.rows = writer.count
+            stage.bytes_written = os.path.getsize(self.output_filename)
 
         self.logger.info("Wrote csv file %s" % (self.output_filename))
         return self
 
-    def to_json(self, fn=None):
-        self._requires_clean_rows()
+    def to_json(self, fn=None, layout="rows"):
+        """
+        Write the rows as a slice rows cache, one row at a time
+
+        @param layout: "rows" writes {"rows": [{field: value}, ...]},
+            "arrays" writes the field names once and each row as a list:
+            {"fields": [...], "rows": [[...], ...]}
+        """
+        self._requires_unread_rows()
 
         if fn is None:
             self.output_filename = self.input_filename + '.clean.json'
@@ -257,31 +811,41 @@ class MandolineCleaner():
             path, _ = os.path.split(os.path.abspath(self.input_filename))
             self.output_filename = os.path.join(path, fn)
 
-        json.dump({"rows": self.rows}, open(self.output_filename, 'wb'),
-                  indent=0)
-        self.logger.info("Wrote json file %s" % (self.output_filename))
+        with self._stage('to_json', self.output_filename) as stage:
+            with open(self.output_filename, 'wb') as outf:
+                writer = JSONRowsWriter(outf, self.flds, layout=layout,
+                                        names=self._output_names())
+                writer.writerows(self._output_rows())
+            stage.rows = writer.count
+            stage.bytes_written = os.path.getsize(self.output_filename)
+        self.logger.info("Wrote %d rows to json file %s" % (
+            writer.count, self.output_filename))
         return self
 
     def refine_fieldnames(self):
+        """
+        Write fields under the names they likely have in slice: lowercase,
+        with spaces converted to underscores
+
+        The rows are not changed. The new names are used when rows are
+        written, so process and aggregate still use the old names.
+        """
         self.logger.info(
             "Converting fieldnames to match refine (lowercase, no spaces)")
         self._requires_clean_rows()
 
-        new_rows = []
-        field_map = {}
-        for k in self.rows[0].keys():
-            field_map[k] = k.lower().replace(' ', '_')
-        for row in self.rows:
-            new_row = {}
-            for k, newk in field_map.items():
-                new_row[newk] = row[k]
-            new_rows.append(new_row)
-        self.rows = new_rows
+        for k in self.flds:
+            name = self.output_names.get(k, k)
+            self.output_names[k] = name.lower().replace(' ', '_')
         return self
 
-    def to_s3_rows_cache(self, fn=None, randomize=False):
+    def to_s3_rows_cache(self, fn=None, randomize=False, compress=False,
+                         threads=4):
         """
         Send output to S3
+
+        Large files are sent as a multipart upload in parallel threads.
+        If compress, the file is gzipped and sent with Content-Encoding: gzip.
         """
         self._requires_clean_rows()
 
@@ -308,21 +872,21 @@ class MandolineCleaner():
             self.logger.info("s3 file name: %s" % (s3_file_name))
 
             try:
-                conn = S3Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-                bucket = conn.create_bucket('slice-rows-cache')
-                k = bucket.new_key(s3_file_name)
-                self.logger.info("Created new s3 file")
+                conn = get_connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY,
+                                      host=S3_HOST, port=S3_PORT,
+                                      is_secure=S3_SECURE)
+                bucket = get_bucket(conn, ROWS_CACHE_BUCKET)
             except Exception as e:
                 raise Exception(
                     "Could not open bucket / create new key {0} {1}".format(
                         s3_file_name, e))
-            k.content_type = 'application/json'
-
-            content = open(self.output_filename, 'r').read()
 
+            uploader = S3Uploader(bucket, threads=threads)
             try:
-                k.set_contents_from_string(content)
-                self.logger.info("Write %d bytes to new file" % (len(content)))
+                with self._stage('to_s3_rows_cache', s3_file_name) as stage:
+                    stage.bytes_read = os.path.getsize(self.output_filename)
+                    stage.bytes_written = uploader.upload(
+                        self.output_filename, s3_file_name, compress=compress)
             except Exception as e:
                 raise Exception("Could not write file to S3 {0}".format(e))
 
@@ -336,7 +900,13 @@ class MandolineMasher(object):
 
     def __init__(self):
         self.logger = logging.getLogger("mandoline.masher")
+        self.collection = None
+
+    # Tests
 
+    def _requires_files(self):
+        assert not self.collection is None, "Needs files"
+        assert self.collection.length > 0, "No files matched"
 
     def files(self, pattern):
         assert isinstance(pattern, basestring), "Pattern must be a glob string"
@@ -344,33 +914,43 @@ class MandolineMasher(object):
         self.logger.info("Matched %d files" % self.collection.length)
         return self
 
-    def to_csv(self, output_filename, delete_headers=True):
+    def _check_headers(self):
         """
-        Concatenates a bunch of files together
+        Check that every file starts with the same header line
         """
-        outf = open(output_filename, 'wb')
-        first = True
+        header = None
         for f in self.collection.collection:
-            lines = open(f).readlines()
-            if first:
-                outf.writelines(lines)
-                self.logger.info(
-                    "Wrote %d lines (including header) from %s to %s" % (
-                        len(lines), f, output_filename))
-            else:
-                if delete_headers:
-                    lines = lines[1:]
-                    outf.writelines(lines)
-                    self.logger.info("Wrote %d lines from %s to %s" % (
-                        len(lines), f, output_filename))
-                else:
-                    outf.writelines(lines)
-                    self.logger.info(
-                        "Wrote %d lines (including header) from %s to %s" % (
-                            len(lines), f, output_filename))
-            first = False
+            with open(f, 'rb') as inf:
+                file_header = inf.readline().rstrip('\r\n')
+            if header is None:
+                header = file_header
+            assert file_header == header, \
+                "Header of {0} does not match: {1}".format(f, file_header[:40])
+
+    def to_csv(self, output_filename, delete_headers=True, check_headers=False,
+               buffer_size=COPY_BUFFER_SIZE):
+        """
+        Concatenates a bunch of files together
+
+        Files are copied in buffer_size chunks and never loaded whole. If
+        delete_headers, the first line of every file after the first is
+        skipped. If check_headers, all files must have the same header.
+        """
+        self._requires_files()
+        if check_headers:
+            self._check_headers()
+
+        with open(output_filename, 'wb') as outf:
+            for idx, f in enumerate(self.collection.collection):
+                with open(f, 'rb') as inf:
+                    if idx > 0 and delete_headers:
+                        inf.readline()
+                    start = inf.tell()
+                    shutil.copyfileobj(inf, outf, buffer_size)
+                    self.logger.info("Wrote %d bytes from %s to %s" % (
+                        inf.tell() - start, f, output_filename))
         self.logger.info("Complete")
-        outf.close()
+        return self
 
 
 class MandolineSlice(object):
@@ -381,7 +961,20 @@ class MandolineSlice(object):
 
     """
 
-    def __init__(self, server_url=None):
+    def __init__(self, server_url=None, timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES, pool_size=HTTP_POOL_SIZE, session=None,
+                 rate_limit=None, cache_ttl=SLICEBOARD_CACHE_TTL, cache=None):
+        """
+        Requests go through one session, which keeps up to pool_size
+        connections to the server alive. Failed connections are retried
+        retries times and requests give up after timeout seconds.
+
+        If rate_limit is set, all MandolineSlices talking to the server
+        together make at most that many requests per second.
+
+        Fetched sliceboards are cached for cache_ttl seconds, after which
+        they are revalidated with a conditional request.
+        """
         self.user = None
         self.api_key = None
         self.server = server_url
@@ -389,6 +982,31 @@ class MandolineSlice(object):
         self.sliceboard_obj = None
         self.collection = None
         self.logger = logging.getLogger("mandoline.slice")
+        self.timeout = timeout
+        self.retries = retries
+        self.pool_size = pool_size
+        if session is None:
+            # requests is only imported once slice is used
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            session = Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size, max_retries=retries)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if server_url:
+                # Create the server's connection pool now, as older urllib3
+                # versions give a host one pool per thread when batch
+                # threads make its first requests at the same time
+                adapter.get_connection("http://" + server_url)
+        self.session = session
+        self.rate_limit = rate_limit
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = host_rate_limiter(server_url, rate_limit)
+        if cache is None:
+            cache = SliceboardCache(cache_ttl)
+        self.cache = cache
 
     # Tests
 
@@ -418,6 +1036,57 @@ class MandolineSlice(object):
     def sliceboard_list_uri(self):
         return "http://{0.server}/api/v1/sliceboard/".format(self)
 
+    def _wait(self):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+
+    def _get(self, url, **kwargs):
+        self._wait()
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+
+    def _put(self, url, **kwargs):
+        self._wait()
+        return self.session.put(url, timeout=self.timeout, **kwargs)
+
+    def _delete(self, url, **kwargs):
+        self._wait()
+        return self.session.delete(url, timeout=self.timeout, **kwargs)
+
+    def _get_cached(self, url, refresh=False):
+        """
+        GET json from url through the sliceboard cache. A stale response
+        is revalidated with If-None-Match / If-Modified-Since, and refresh
+        always asks the server.
+        """
+        cached, fresh = self.cache.get(url)
+        if fresh and not refresh:
+            return cached.obj
+
+        headers = cached.validators if cached is not None else {}
+        response = self._get(url, headers=headers, stream=False)
+        if response.status_code == 304 and cached is not None:
+            self.cache.revalidated(url)
+            return cached.obj
+        assert response.status_code == 200, \
+            "Got status code {0} for {1}".format(response.status_code, url)
+        obj = response.json()
+        self.cache.put(url, obj, response.headers.get('etag'),
+                       response.headers.get('last-modified'))
+        return obj
+
+    def _copy(self):
+        """
+        A MandolineSlice for the same server and user that shares this
+        one's session
+        """
+        other = MandolineSlice(self.server, timeout=self.timeout,
+                               retries=self.retries, pool_size=self.pool_size,
+                               session=self.session,
+                               rate_limit=self.rate_limit, cache=self.cache)
+        other.user = self.user
+        other.api_key = self.api_key
+        return other
+
     # General commands
 
     def authenticate(self, user, api_key):
@@ -439,10 +1108,36 @@ class MandolineSlice(object):
             print
 
 
-    def show_sliceboards(self, full=False):
-        response = http_get(self.sliceboard_list_uri + self.auth_params,
-                            stream=False)
-        for sb in response.json()["objects"]:
+    def iter_sliceboards(self, page_size=100, fields=None):
+        """
+        Generate the sliceboards, fetching page_size of them at a time
+
+        If fields is a list of field names, only those are requested and
+        kept in each sliceboard.
+        """
+        offset = 0
+        while True:
+            url = "{0}{1}&limit={2}&offset={3}".format(
+                self.sliceboard_list_uri, self.auth_params, page_size, offset)
+            if fields:
+                url += "&fields=" + ",".join(fields)
+            response = self._get(url, stream=False)
+            assert response.status_code == 200
+            page = response.json()
+            objects = page["objects"]
+            for sb in objects:
+                if fields:
+                    sb = dict((k, sb[k]) for k in fields if k in sb)
+                yield sb
+            offset += len(objects)
+            meta = page.get("meta", {})
+            if (not objects or not meta.get("next") or
+                    offset >= meta.get("total_count", offset + 1)):
+                break
+
+    def show_sliceboards(self, full=False, page_size=100):
+        fields = None if full else ["id", "title"]
+        for sb in self.iter_sliceboards(page_size, fields):
             self._show_sliceboard(sb, full)
         return self
 
@@ -452,16 +1147,18 @@ class MandolineSlice(object):
         return self
 
 
-    def sliceboard(self, sliceboard_id):
+    def sliceboard(self, sliceboard_id, refresh=False):
         """
         Get a sliceboard object
+
+        Sliceboards are cached, so asking for the same sliceboard again
+        doesn't go to the server until the cache ttl passes. Use
+        refresh=True to check with the server anyway.
         """
         self.sliceboard_id = sliceboard_id
-        response = http_get(self.sliceboard_detail_uri + self.auth_params,
-                            stream=False)
-        self.sliceboard_obj = response.json()
+        self.sliceboard_obj = self._get_cached(
+            self.sliceboard_detail_uri + self.auth_params, refresh)
         self.logger.info(str(self.sliceboard_obj['title']))
-        assert response.status_code == 200
         return self
 
     def title(self, new_title="Untitled"):
@@ -480,8 +1177,9 @@ class MandolineSlice(object):
         headers = {"content-type": "application/json; charset=utf8"}
         put_url = self.sliceboard_detail_uri + self.auth_params
         data = {"title": new_title.format(self.sliceboard_obj)}
-        response = http_put(put_url, data=json.dumps(data), headers=headers)
+        response = self._put(put_url, data=json.dumps(data), headers=headers)
         assert response.status_code == 202
+        self.cache.invalidate(put_url)
         return self
 
     def delete(self):
@@ -492,8 +1190,9 @@ class MandolineSlice(object):
             raise Exception("Need a sliceboard")
         delete_url = self.sliceboard_detail_uri + self.auth_params
         print "Deleting", delete_url
-        response = http_delete(delete_url)
+        response = self._delete(delete_url)
         assert response.status_code == 204
+        self.cache.invalidate(delete_url)
         self.sliceboard_id = None
         self.sliceboard_obj = None
         return self
@@ -507,7 +1206,7 @@ class MandolineSlice(object):
             raise Exception("Need a sliceboard")
         duplicate_url = "{0.sliceboard_detail_uri}/duplicate{0.auth_params}".format(
             self)
-        response = http_get(duplicate_url, stream=False)
+        response = self._get(duplicate_url, stream=False)
         self.duplicate_obj = response.json()
 
         return self
@@ -526,8 +1225,76 @@ class MandolineSlice(object):
             'data'] + '/set_rows_cache' + self.auth_params
         data = {'s3_rows_cache': filename}
         self.logger.info('Replacing data: ' + put_url)
-        response = http_put(put_url, data=json.dumps(data), headers=headers)
+        response = self._put(put_url, data=json.dumps(data), headers=headers)
         self.logger.info(
             'Replacing data: status code ' + str(response.status_code))
+        self.cache.invalidate(self.sliceboard_detail_uri + self.auth_params)
+        return self
+
+    def batch(self, sliceboard_ids, operation, *args, **kwargs):
+        """
+        Run an operation on many sliceboards at once, in a pool of threads
+        that share this MandolineSlice's connections.
+
+        operation is the name of a MandolineSlice method, called with args
+        and kwargs after the sliceboard is loaded, or a function that is
+        given the loaded MandolineSlice. For instance
+
+        MandolineSlice(url).authenticate(user, key).batch([1, 2, 3], "duplicate")
+        MandolineSlice(url).authenticate(user, key).batch(ids, "replace_data", "rows.json")
+
+        Afterwards batch_results maps each sliceboard id that succeeded to
+        its MandolineSlice, and batch_errors maps the ones that failed to
+        the exception. Pass workers=n to change the number of threads, and
+        rate_limit on the MandolineSlice to cap the requests per second.
+        """
+        self._requires_auth()
+        workers = kwargs.pop('workers', self.pool_size)
+        sliceboard_ids = list(sliceboard_ids)
+
+        def run(sliceboard_id):
+            try:
+                other = self._copy().sliceboard(sliceboard_id)
+                if isinstance(operation, basestring):
+                    getattr(other, operation)(*args, **kwargs)
+                else:
+                    operation(other)
+                return sliceboard_id, other, None
+            except Exception as e:
+                self.logger.warning("Sliceboard {0} failed: {1}".format(
+                    sliceboard_id, e))
+                return sliceboard_id, None, e
+
+        self.batch_results = {}
+        self.batch_errors = {}
+        if not sliceboard_ids:
+            return self
+        pool = ThreadPool(min(workers, len(sliceboard_ids)))
+        try:
+            for sliceboard_id, other, error in pool.imap_unordered(
+                    run, sliceboard_ids):
+                if error is None:
+                    self.batch_results[sliceboard_id] = other
+                else:
+                    self.batch_errors[sliceboard_id] = error
+        finally:
+            pool.close()
+            pool.join()
+        self.logger.info("Batch finished, {0} succeeded, {1} failed".format(
+            len(self.batch_results), len(self.batch_errors)))
+        return self
+
+    def show_batch_results(self):
+        """
+        Print the outcome of the last batch for every sliceboard
+        """
+        for sliceboard_id in sorted(self.batch_results):
+            print "{0:4d} ok ".format(sliceboard_id) + \
+                self.batch_results[sliceboard_id].sliceboard_obj['title']
+        for sliceboard_id in sorted(self.batch_errors):
+            print "{0:4d} failed: {1}".format(
+                sliceboard_id, self.batch_errors[sliceboard_id])
+        print "{0} succeeded, {1} failed".format(
+            len(self.batch_results), len(self.batch_errors))
         return self
 
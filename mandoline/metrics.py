@@ -0,0 +1,133 @@
+"""
+Records what each stage of a MandolineCleaner run took
+"""
+
+import cStringIO
+import resource
+import sys
+import time
+
+
+def peak_memory_kb():
+    """
+    The most memory the process has used so far. ru_maxrss is in bytes
+    on OS X and kilobytes elsewhere.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def cleaner_name(cleaner):
+    """
+    Describe a cleaner, including the function a CleanWith calls and the
+    cleaner a Memoize wraps
+    """
+    name = cleaner.__class__.__name__
+    func = getattr(cleaner, 'clean_func', None)
+    if func is not None:
+        name += '(%s)' % getattr(func, '__name__', repr(func))
+    inner = getattr(cleaner, 'cleaner', None)
+    if inner is not None:
+        name += '(%s)' % cleaner_name(inner)
+    return name
+
+
+def timed(fn, timings, key):
+    """
+    Wrap fn to add the time spent in each call to timings[key]
+    """
+    timer = time.time
+
+    def timed_fn(*args):
+        start = timer()
+        try:
+            return fn(*args)
+        finally:
+            timings[key] = timings.get(key, 0.0) + timer() - start
+    return timed_fn
+
+
+class Stage(object):
+    """
+    One step of a run, such as loading a file or writing json. detail
+    says what it worked on, usually a file name.
+    """
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.seconds = 0.0
+        self.rows = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.peak_memory_kb = None
+        self.profile = None
+        self.error = None
+
+    def profile_text(self, sort='cumulative', limit=20):
+        """
+        The slowest functions of a profiled stage
+        """
+        if self.profile is None:
+            return ''
+        import pstats
+        out = cStringIO.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'detail': self.detail,
+            'seconds': round(self.seconds, 6),
+            'rows': self.rows,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_memory_kb': self.peak_memory_kb,
+            'error': self.error,
+        }
+
+
+class RunReport(object):
+    """
+    The stages of a run in the order they finished, and the seconds spent
+    in each cleaner of each field when cleaners are timed
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.cleaner_seconds = {}
+
+    def stage(self, name):
+        """
+        The stages with this name
+        """
+        return [s for s in self.stages if s.name == name]
+
+    @property
+    def seconds(self):
+        return sum(s.seconds for s in self.stages)
+
+    def to_dict(self):
+        return {
+            'seconds': round(self.seconds, 6),
+            'stages': [s.to_dict() for s in self.stages],
+            'cleaners': [
+                {'field': field, 'cleaner': cleaner,
+                 'seconds': round(seconds, 6)}
+                for (field, cleaner), seconds in sorted(
+                    self.cleaner_seconds.iteritems())],
+        }
+
+    def show(self):
+        for s in self.stages:
+            print "{0:<20} {1:8.3f}s {2:>10} rows  {3}".format(
+                s.name, s.seconds, s.rows if s.rows is not None else '-',
+                s.detail or '')
+        for (field, cleaner), seconds in sorted(
+                self.cleaner_seconds.iteritems(), key=lambda i: -i[1]):
+            print "\t{0:8.3f}s {1} {2}".format(seconds, field, cleaner)
+
@@ -0,0 +1,63 @@
+"""
+Limits the rate of requests made to a host across threads
+"""
+
+import threading
+import time
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+class RateLimiter(object):
+    """
+    A token bucket that lets through rate calls per second on average,
+    with bursts of up to burst calls. wait() blocks until a call is
+    allowed and is safe to use from many threads.
+    """
+
+    def __init__(self, rate, burst=None):
+        assert rate > 0, "rate must be positive"
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        """
+        Change the rate, keeping the tokens already saved up
+        """
+        assert rate > 0, "rate must be positive"
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = burst or max(1, int(rate))
+            self.tokens = min(self.tokens, self.burst)
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def host_rate_limiter(host, rate, burst=None):
+    """
+    Returns the RateLimiter for host, so every client talking to the
+    same host shares one limit. Asking for a different rate changes the
+    limit of every client of the host.
+    """
+    with _lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = _limiters[host] = RateLimiter(rate, burst)
+        elif limiter.rate != rate or (burst and limiter.burst != burst):
+            limiter.set_rate(rate, burst)
+    return limiter
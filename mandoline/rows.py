@@ -0,0 +1,183 @@
+"""
+Compact rows: a shared schema of field names and one list of values per
+row, instead of a dict per row
+"""
+
+from itertools import izip
+
+
+class _Missing(object):
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+# The value of a field a row doesn't have
+MISSING = _Missing()
+
+
+class RowSchema(object):
+    """
+    The field names of compact rows, in order, and their positions
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.index = dict((name, idx) for idx, name in enumerate(self.fields))
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return '<RowSchema %r>' % self.fields
+
+
+class CompactRow(object):
+    """
+    A row that behaves like a dict but keeps its values in a list, with
+    the field names in a RowSchema shared by every row. A field that
+    isn't in the schema is kept in a small dict of extra fields.
+
+    A CompactRow with ten fields takes about a fifth of the memory of
+    the same row as a dict, but reading and writing fields is slower.
+    """
+
+    __slots__ = ('schema', 'data', 'extra')
+
+    def __init__(self, schema, data, extra=None):
+        self.schema = schema
+        self.data = data
+        self.extra = extra
+
+    def __reduce__(self):
+        return (CompactRow, (self.schema, self.data, self.extra))
+
+    def __getitem__(self, key):
+        idx = self.schema.index.get(key)
+        if idx is not None:
+            value = self.data[idx]
+            if value is not MISSING:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        idx = self.schema.index.get(key)
+        if idx is not None:
+            self.data[idx] = value
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        idx = self.schema.index.get(key)
+        if idx is not None and self.data[idx] is not MISSING:
+            self.data[idx] = MISSING
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        idx = self.schema.index.get(key)
+        if idx is not None:
+            return self.data[idx] is not MISSING
+        return self.extra is not None and key in self.extra
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        idx = self.schema.index.get(key)
+        if idx is not None:
+            value = self.data[idx]
+            return default if value is MISSING else value
+        if self.extra is not None:
+            return self.extra.get(key, default)
+        return default
+
+    def iteritems(self):
+        for name, value in zip(self.schema.fields, self.data):
+            if value is not MISSING:
+                yield name, value
+        if self.extra:
+            for item in self.extra.iteritems():
+                yield item
+
+    def iterkeys(self):
+        for name, value in self.iteritems():
+            yield name
+
+    def itervalues(self):
+        for name, value in self.iteritems():
+            yield value
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        return sum(1 for _ in self.iteritems())
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        for key, value in other:
+            self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def values_for(self, fieldnames, default=None):
+        """
+        The values of fieldnames in order, with default for fields the
+        row doesn't have. When fieldnames are the schema's fields this
+        is the row's own list of values.
+        """
+        if self.schema.fields == fieldnames and MISSING not in self.data:
+            return self.data
+        get = self.get
+        return [get(k, default) for k in fieldnames]
+
+    def as_dict(self):
+        if self.extra is None and MISSING not in self.data:
+            return dict(izip(self.schema.fields, self.data))
+        return dict(self.iteritems())
+
+    copy = as_dict
+
+    def __eq__(self, other):
+        if isinstance(other, CompactRow):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'CompactRow(%r)' % self.as_dict()
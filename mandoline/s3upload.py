@@ -0,0 +1,149 @@
+"""
+Uploads files to S3, in parallel parts for large files
+"""
+
+import cStringIO
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger("mandoline.s3")
+
+# S3 needs every part but the last to be at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+
+_connections = {}
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_connection(access_key, secret_key, host=None, port=None,
+                   is_secure=True):
+    """
+    Returns an S3Connection, reusing one connection (and its pool of
+    http connections) for the same settings.
+
+    host and port can point at a local S3-compatible server.
+    """
+    # boto is only imported once S3 is used
+    from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+
+    settings = (access_key, secret_key, host, port, is_secure)
+    with _lock:
+        conn = _connections.get(settings)
+        if conn is None:
+            kwargs = {}
+            if host is not None:
+                kwargs = dict(host=host, port=port, is_secure=is_secure,
+                              calling_format=OrdinaryCallingFormat())
+            conn = S3Connection(access_key, secret_key, **kwargs)
+            _connections[settings] = conn
+    return conn
+
+
+def get_bucket(conn, bucket_name):
+    """
+    Returns the bucket, creating it the first time it is used
+    """
+    with _lock:
+        bucket = _buckets.get((conn, bucket_name))
+        if bucket is None:
+            bucket = conn.create_bucket(bucket_name)
+            _buckets[(conn, bucket_name)] = bucket
+    return bucket
+
+
+def gzip_file(filename):
+    """
+    Compress filename to a temporary file and return its name
+    """
+    fd, gz_filename = tempfile.mkstemp(suffix='.gz')
+    os.close(fd)
+    with open(filename, 'rb') as inf:
+        with gzip.open(gz_filename, 'wb') as outf:
+            shutil.copyfileobj(inf, outf, PART_SIZE)
+    return gz_filename
+
+
+class S3Uploader(object):
+    """
+    Uploads files to a bucket. Files bigger than part_size are sent as a
+    multipart upload, reading parts from disk in a pool of threads and
+    retrying each failed part up to retries times.
+    """
+
+    def __init__(self, bucket, part_size=PART_SIZE, threads=4, retries=3,
+                 retry_delay=1):
+        self.bucket = bucket
+        self.part_size = part_size
+        self.threads = threads
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def _retry(self, description, fn, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Retrying %s after error: %s" % (description, e))
+                time.sleep(self.retry_delay * (attempt + 1))
+
+    def upload(self, filename, key_name, content_type='application/json',
+               compress=False):
+        """
+        Upload filename to key_name and return the number of bytes sent
+
+        If compress, the file is gzipped first and sent with
+        Content-Encoding: gzip.
+        """
+        headers = {'Content-Type': content_type}
+        if compress:
+            headers['Content-Encoding'] = 'gzip'
+            filename = gzip_file(filename)
+        try:
+            size = os.path.getsize(filename)
+            if size <= self.part_size:
+                key = self.bucket.new_key(key_name)
+                self._retry("upload of " + key_name,
+                            key.set_contents_from_filename, filename, headers)
+            else:
+                self._upload_parts(filename, size, key_name, headers)
+        finally:
+            if compress:
+                os.remove(filename)
+        logger.info("Wrote %d bytes to %s" % (size, key_name))
+        return size
+
+    def _upload_parts(self, filename, size, key_name, headers):
+        mp = self.bucket.initiate_multipart_upload(key_name, headers=headers)
+
+        def upload_part(part_num):
+            with open(filename, 'rb') as f:
+                f.seek((part_num - 1) * self.part_size)
+                data = f.read(self.part_size)
+
+            def send():
+                mp.upload_part_from_file(cStringIO.StringIO(data), part_num,
+                                         size=len(data))
+
+            self._retry("part %d of %s" % (part_num, key_name), send)
+            logger.debug("Sent part %d of %s" % (part_num, key_name))
+
+        parts = range(1, (size + self.part_size - 1) // self.part_size + 1)
+        pool = ThreadPool(min(self.threads, len(parts)))
+        try:
+            pool.map(upload_part, parts)
+            mp.complete_upload()
+        except Exception:
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.close()
+            pool.join()
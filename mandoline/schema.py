@@ -0,0 +1,132 @@
+"""
+Infers the type of each column from a sample of rows, and the cleaners
+that convert them
+"""
+
+import re
+
+from cleaners import Date, FieldCleaner, Float, Int
+
+# Types a column can be inferred as, from most to least specific
+TYPES = ('empty', 'int', 'float', 'date', 'categorical', 'string')
+
+DATE_FORMATS = ("%m-%d-%Y", "%Y-%m-%d", "%m/%d/%Y")
+
+# (thousands, decimal) separators numbers are tried with, in order
+NUMBER_FORMATS = ((None, '.'), (',', '.'), ('.', ','))
+
+
+# Numbers with a leading zero, like zip codes and ids, are kept as text
+LEADING_ZERO = re.compile(r'\s*[+-]?0\d')
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, basestring) and
+                             not value.strip())
+
+
+class ColumnType(object):
+    """
+    What was inferred about a column: its type, the date format of date
+    columns and how many sampled values were empty or distinct
+    """
+
+    def __init__(self, name, type, sampled=0, empty=0, distinct=0,
+                 format=None, thousands=None, decimal='.'):
+        self.name = name
+        self.type = type
+        self.sampled = sampled
+        self.empty = empty
+        self.distinct = distinct
+        self.format = format
+        self.thousands = thousands
+        self.decimal = decimal
+
+    def cleaners(self):
+        """
+        The cleaners that convert values of this type. Values that don't
+        parse become None.
+        """
+        if self.type == 'int':
+            return [Int(None, self.thousands, self.decimal)]
+        if self.type == 'float':
+            return [Float(None, self.thousands, self.decimal)]
+        if self.type == 'date':
+            return [Date(self.format)]
+        return []
+
+    def field(self):
+        return FieldCleaner(self.name, *self.cleaners())
+
+    def __repr__(self):
+        description = self.type
+        if self.format:
+            description += ' ' + self.format
+        return "<ColumnType {0}: {1}, {2} sampled, {3} empty, {4} distinct>" \
+            .format(self.name, description, self.sampled, self.empty,
+                    self.distinct)
+
+
+def infer_column(name, values, thousands=None, decimal=None,
+                 categorical_ratio=0.5, date_formats=DATE_FORMATS):
+    """
+    Infer the type of a column from a sample of its values
+
+    A column is an int, float or date column if every value that isn't
+    empty parses as one. Otherwise it is categorical if there are at most
+    categorical_ratio distinct values per value, and a string otherwise.
+
+    Numbers are read with the thousands and decimal separators given.
+    If decimal is None, each of NUMBER_FORMATS is tried in turn and the
+    first that reads every value is kept, so "1,5" is the float 1.5 and
+    never the integer 15. Columns with values like "02134" are never
+    numbers, because their leading zeros would be lost.
+    """
+    values = list(values)
+    present = [v for v in values if not _is_empty(v)]
+    distinct = set(present)
+    column = ColumnType(name, 'empty', len(values), len(values) - len(present),
+                        len(distinct))
+    if not present:
+        return column
+
+    def parses(parser):
+        for v in distinct:
+            if parser(v) is None:
+                return False
+        return True
+
+    if decimal is None:
+        formats = NUMBER_FORMATS
+    else:
+        formats = ((thousands, decimal),)
+    if any(isinstance(v, basestring) and LEADING_ZERO.match(v)
+           for v in distinct):
+        formats = ()
+    for thousands, decimal in formats:
+        for cls, type in ((Int, 'int'), (Float, 'float')):
+            if parses(cls(None, thousands, decimal).parse):
+                column.type = type
+                column.thousands = thousands
+                column.decimal = decimal
+                return column
+    for format in date_formats:
+        if parses(Date(format).parse):
+            column.type = 'date'
+            column.format = format
+            return column
+    if len(distinct) <= categorical_ratio * len(present):
+        column.type = 'categorical'
+    else:
+        column.type = 'string'
+    return column
+
+
+def infer_schema(rows, names, **kwargs):
+    """
+    Infer a ColumnType for each of names from a sample of dict rows.
+    kwargs are passed to infer_column.
+    """
+    rows = list(rows)
+    return [infer_column(name, [row.get(name) for row in rows], **kwargs)
+            for name in names]
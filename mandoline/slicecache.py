@@ -0,0 +1,82 @@
+"""
+Caches sliceboards fetched from slice, revalidating them with the server
+once they are older than the cache's ttl
+"""
+
+import threading
+import time
+
+from cleaners import LRUCache
+
+
+class CachedResponse(object):
+    def __init__(self, obj, etag=None, last_modified=None):
+        self.obj = obj
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.time()
+
+    @property
+    def validators(self):
+        """
+        Headers that ask the server to reply 304 if obj hasn't changed
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class SliceboardCache(object):
+    """
+    Holds up to maxsize responses by url. A response younger than ttl
+    seconds is used as it is. An older one is revalidated with a
+    conditional request if the server gave an ETag or Last-Modified, and
+    is evicted otherwise. Safe to share between threads.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024):
+        self.ttl = ttl
+        self.responses = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Returns (response, fresh), where response is None if url isn't
+        cached and fresh is True if it can be used without asking the server
+        """
+        with self.lock:
+            response = self.responses.get(url)
+            if response is None:
+                return None, False
+            if time.time() - response.fetched < self.ttl:
+                return response, True
+            if not response.validators:
+                self.responses.pop(url)
+                return None, False
+            return response, False
+
+    def put(self, url, obj, etag=None, last_modified=None):
+        with self.lock:
+            self.responses[url] = CachedResponse(obj, etag, last_modified)
+
+    def revalidated(self, url):
+        """
+        The server said the cached response for url hasn't changed
+        """
+        with self.lock:
+            response = self.responses.get(url)
+            if response is not None:
+                response.fetched = time.time()
+
+    def invalidate(self, url=None):
+        """
+        Forget url, or everything if no url is given
+        """
+        with self.lock:
+            if url is None:
+                self.responses.clear()
+            else:
+                self.responses.pop(url)
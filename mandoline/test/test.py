@@ -1,6 +1,8 @@
 import glob
 from nose.tools import with_setup
 import os
+import shutil
+import tempfile
 from mandoline import *
 from mandoline import FieldCleaner as _
 
@@ -53,6 +55,25 @@ def teardown():
     pass
 
 
+# A temporary directory for the test being run, see make_tmpdir
+tmpdir = None
+
+
+def make_tmpdir():
+    """ Create a temporary directory for a test's files
+    """
+    global tmpdir
+    tmpdir = tempfile.mkdtemp(prefix='mandoline-test-')
+
+
+def remove_tmpdir():
+    """ Remove the test's temporary directory and everything in it
+    """
+    global tmpdir
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    tmpdir = None
+
+
 @with_setup(setup, teardown)
 def test():
     full_path = os.path.realpath(__file__)
@@ -76,3 +97,1112 @@ def test():
     except IOError:
         assert 1 == 0, "File does not exist"
 
+
+
+def write_sample_csv(path, rows=10):
+    """ Write a small csv file with a few columns to path
+    """
+    with open(path, 'wb') as f:
+        f.write("Name,State,Date,Count,Extra\n")
+        for i in xrange(rows):
+            f.write("name %d,Virginia,01-%02d-2013,%d,junk\n" % (i, i % 28 + 1, i))
+    return path
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_stream():
+    import json
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=50)
+
+    cleaner = MandolineCleaner()
+    cleaner.files(fn).set_fields(_('Name'),
+                                 _('State', StateAbbrevLookup()),
+                                 _('Count', Int())).clean(stream=True)
+    assert not isinstance(cleaner.rows, list)
+    cleaner.to_json("stream.json")
+    rows = json.load(open(os.path.join(tmpdir, "stream.json")))["rows"]
+    assert len(rows) == 50
+    assert rows[3] == {"Name": "name 3", "State": "VA", "Count": 3}
+
+    cleaner.clean(stream=True).to_csv(os.path.join(tmpdir, "stream.csv"))
+    lines = open(os.path.join(tmpdir, "stream.csv")).read().splitlines()
+    assert lines[0] == "Name,State,Count"
+    assert lines[1] == "name 0,VA,0"
+    assert len(lines) == 51
+
+    # Streamed rows can only be written once
+    try:
+        cleaner.to_json(os.path.join(tmpdir, "again.json"))
+    except AssertionError:
+        pass
+    else:
+        assert False, "Wrote streamed rows twice"
+    assert not os.path.exists(os.path.join(tmpdir, "again.json"))
+
+    cleaner.clean(stream=True).aggregate("Count")
+    cleaner.to_csv(os.path.join(tmpdir, "sum.csv"))
+    cleaner.to_json(os.path.join(tmpdir, "sum.json"))
+    assert len(json.load(open(os.path.join(tmpdir, "sum.json")))["rows"]) == 50
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_multiple_files():
+    for i in range(3):
+        write_sample_csv(os.path.join(tmpdir, "part%d.csv" % i), rows=10 + i)
+
+    for workers in (None, 2):
+        cleaner = MandolineCleaner()
+        cleaner.files(os.path.join(tmpdir, "*.csv")).set_fields(
+            _('Name'), _('Count', Int()),
+            _('State', CleanWith(lambda d, fn: d.update({fn: d[fn][:2]})))
+        ).clean(workers=workers)
+        assert len(cleaner.rows) == 10 + 11 + 12
+        assert [r['Count'] for r in cleaner.rows[8:13]] == [8, 9, 0, 1, 2]
+        assert cleaner.rows[0]['State'] == 'Vi'
+
+    # a failing file stops the pool without waiting for the other files
+    import time
+    for i in range(7):
+        with open(os.path.join(tmpdir, "slow%d.csv" % i), "wb") as f:
+            f.write("Name\n%s\n" % ("bad" if i == 0 else "slow"))
+
+    def slow(d, fn):
+        if d[fn] == 'bad':
+            raise ValueError("Bad name")
+        time.sleep(0.5)
+
+    cleaner = MandolineCleaner().files(os.path.join(tmpdir, "slow*.csv"))
+    cleaner.set_fields(_('Name', CleanWith(slow)))
+    start = time.time()
+    try:
+        cleaner.clean(workers=2)
+    except ValueError:
+        pass
+    else:
+        assert False, "Expected the worker's error"
+    assert time.time() - start < 1.5
+
+
+def test_compiled_row_cleaner():
+    """ Compare the compiled row cleaner against per-row FieldCleaner.clean
+    """
+    import time
+    fields = [_('Name'),
+              _('State=>state', StateAbbrevLookup()),
+              _('Count', Int()),
+              _('Date', Date(), extra_fields_to_save='Extra')]
+    output_fields = ['Name', 'state', 'Count', 'Date', 'Extra']
+
+    def make_rows():
+        return [{'Name': 'name %d' % i, 'State': 'Virginia',
+                 'Date': '01-02-2013', 'Count': str(i), 'Extra': 'x',
+                 'Unused1': 'a', 'Unused2': 'b'} for i in xrange(20000)]
+
+    def clean_per_row(rows):
+        fld_set = set(output_fields)
+        result = []
+        for row in rows:
+            for field in fields:
+                field.clean(row)
+            for k in list(row.keys()):
+                if k not in fld_set:
+                    del row[k]
+            result.append(row)
+        return result
+
+    rows = make_rows()
+    start = time.time()
+    expected = clean_per_row(rows)
+    before = time.time() - start
+
+    clean_row = compile_row_cleaner(fields, output_fields)
+    rows = make_rows()
+    start = time.time()
+    result = map(clean_row, rows)
+    after = time.time() - start
+
+    print "Per-row dispatch: %.3fs, compiled: %.3fs" % (before, after)
+    assert result == expected
+    assert result[5] == {'Name': 'name 5', 'state': 'VA', 'Count': 5,
+                         'Date': expected[5]['Date'], 'Extra': 'x'}
+    assert clean_row({'Name': 'a', 'State': 'Ohio', 'Count': '1',
+                      'Date': ''}) == {'Name': 'a', 'state': 'OH',
+                                       'Count': 1, 'Date': None}
+
+
+def test_date():
+    from datetime import datetime
+    from time import mktime
+
+    def expected(value, format):
+        try:
+            return int(mktime(datetime.strptime(value, format).timetuple())) * 1000
+        except (TypeError, ValueError):
+            return None
+
+    values = ['07-10-2013', '7-1-2013', '02-29-2012', '02-29-2013',
+              '13-01-2013', '1-1-13', '07-10-2013x', 'fred', '', None,
+              '2013-07-10', '2013-7-1', '2013-02-30']
+    for format in ("%m-%d-%Y", "%Y-%m-%d"):
+        cleaner = Date(format, cache_size=4)
+        for value in values + values:
+            d = {'a': value}
+            cleaner.clean(d, 'a')
+            assert d['a'] == expected(value, format), (value, d['a'])
+        assert len(cleaner.cache) == 4
+        assert cleaner.misses + cleaner.hits == 2 * len(values)
+
+    cleaner = Date(cache_size=10)
+    for i in range(100):
+        cleaner.clean({'a': '01-0%d-2013' % (i % 5 + 1)}, 'a')
+    assert cleaner.misses == 5
+    assert cleaner.hits == 95
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_columnar():
+    from nose.plugins.skip import SkipTest
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest("numpy is not installed")
+
+    for i in range(2):
+        write_sample_csv(os.path.join(tmpdir, "part%d.csv" % i), rows=40)
+
+    def make_fields():
+        return [_('Name', CleanWith(lambda d, fn: d.update({fn: d[fn][:6]}))),
+                _('State=>state', StateAbbrevLookup()),
+                _('Date', Date()),
+                _('Count', Int())]
+
+    results = []
+    for engine in (MandolineCleaner, ColumnarCleaner):
+        cleaner = engine()
+        cleaner.files(os.path.join(tmpdir, "*.csv")).set_fields(
+            *make_fields()).clean()
+        rows = sorted(cleaner._output_rows())
+        if engine is ColumnarCleaner:
+            # strings are objects, not as wide as the longest string
+            assert cleaner.columns['Name'].dtype == object
+            assert cleaner.columns['Count'].dtype == numpy.int64
+        cleaner.aggregate('Count')
+        results.append((rows, sorted(cleaner._output_rows())))
+
+    assert results[0] == results[1]
+    assert len(results[1][0]) == 80
+    assert len(results[1][1]) == 39
+
+
+def write_sample_xlsx(path, rows=10):
+    """ Write a small xlsx file with a few columns to path
+    """
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.get_active_sheet()
+    ws.append(["Extra", "Name", "State", "Date", "Count", "Score", "Unused"])
+    for i in xrange(rows):
+        ws.append(["junk", "name %d" % i, "Virginia",
+                   "01-%02d-2013" % (i % 28 + 1), i, i + 0.5, None])
+    wb.save(path)
+    return path
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_xlsx():
+    from openpyxl import load_workbook
+    fn = write_sample_xlsx(os.path.join(tmpdir, "sample.xlsx"), rows=30)
+
+    cleaner = MandolineCleaner()
+    cleaner.set_fields(_('Name'), _('Count'), _('Score'), _('Date', Date()))
+    cleaner.loadxlsx(fn)
+    assert len(cleaner.inputrows) == 30
+
+    # Compare against loading the whole workbook
+    wb = load_workbook(fn)
+    sht = wb.get_sheet_by_name(wb.get_sheet_names()[0])
+    header = [c.value for c in sht.rows[0]]
+    for loaded, row in zip(cleaner.inputrows, sht.rows[1:]):
+        full = dict(zip(header, [c.value for c in row]))
+        assert loaded == dict((k, full[k]) for k in
+                              ('Name', 'Count', 'Score', 'Date'))
+
+    # floats stay floats, even when they are whole numbers
+    from openpyxl import Workbook
+    wb = Workbook()
+    ws = wb.get_active_sheet()
+    ws.append(["Ratio", "Flag"])
+    ws.append([3.0, True])
+    wb.save(fn)
+    cleaner = MandolineCleaner().set_fields(_('Ratio'), _('Flag')).loadxlsx(fn)
+    full = load_workbook(fn)
+    row = full.get_sheet_by_name(full.get_sheet_names()[0]).rows[1]
+    assert [c.value for c in row] == [3.0, 1]
+    loaded = cleaner.inputrows[0]
+    assert loaded == {'Ratio': 3.0, 'Flag': 1}
+    assert type(loaded['Ratio']) is float and type(loaded['Flag']) is int
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_csv_projection():
+    fn = os.path.join(tmpdir, "sample.csv")
+    with open(fn, 'wb') as f:
+        f.write('A,B,C,D,E\n1,2,"3\n3",4,5\n\n6,7\n')
+
+    cleaner = MandolineCleaner()
+    cleaner.set_fields(_('B=>b'), _('C', extra_fields_to_save='E'))
+    cleaner.loadcsv(fn)
+    assert cleaner.inputrows == [{'B': '2', 'C': '3\n3', 'E': '5'},
+                                 {'B': '7', 'C': None, 'E': None}]
+    cleaner._cleanrows()
+    assert cleaner.rows[0] == {'b': '2', 'C': '3\n3', 'E': '5'}
+
+    # a cleaner can read a column that isn't output
+    join = CleanWith(lambda d, fn: d.update({fn: (d[fn], d['D'])}))
+    from mandoline.columnar import ColumnarCleaner
+    for engine in (MandolineCleaner, ColumnarCleaner):
+        cleaner = engine().files(fn).set_fields(_('A', join, reads='D'),
+                                                 _('B'))
+        rows = cleaner.clean().rows if engine is MandolineCleaner else \
+            list(cleaner.clean()._output_rows())
+        assert rows == [{'A': ('1', '4'), 'B': '2'},
+                        {'A': ('6', None), 'B': '7'}], engine
+        cleaner.to_csv(os.path.join(tmpdir, "out.csv"))
+        assert open(os.path.join(tmpdir, "out.csv")).readline().strip() == \
+            "A,B"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_aggregated_fields():
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=20)
+    out = os.path.join(tmpdir, "out.csv")
+    fields = (_('State', StateAbbrevLookup()), _('Count', Int()))
+
+    seen = []
+    cleaner = MandolineCleaner().files(fn).set_fields(*fields).clean()
+    cleaner.aggregate('Count', Count(output_name='rows'))
+    cleaner.process(lambda c: seen.extend(c.rows)).to_csv(out)
+    assert cleaner.flds == ['State', 'Count', 'rows']
+    assert open(out).read().splitlines() == ["State,Count,rows", "VA,190,20"]
+    assert seen == [{'State': 'VA', 'Count': 190, 'rows': 20}]
+
+    cleaner = MandolineCleaner().files(fn).set_fields(*fields).clean()
+    cleaner.aggregate(Mean('Count', 'avg')).drop_field('State').to_csv(out)
+    assert open(out).read().splitlines() == ["avg", "9.5"]
+
+    # cleaning again goes back to the fields of set_fields
+    cleaner.set_fields(*fields).clean().to_csv(out)
+    assert open(out).read().splitlines()[:2] == ["State,Count", "VA,0"]
+
+
+def test_aggregate():
+    from mandoline import columnar
+    rows = [{'a': i % 3, 'b': 'x' if i % 2 else 'y', 'n': i,
+             'm': None if i == 4 else i % 4} for i in range(30)]
+
+    def aggregate(engine, *reducers, **kwargs):
+        cleaner = engine()
+        cleaner.set_fields(_('a'), _('b'), _('n'), _('m'))
+        if engine is MandolineCleaner:
+            cleaner.rows = [dict(row) for row in rows]
+        else:
+            cleaner.columns = dict((k, columnar._to_array([r[k] for r in rows]))
+                                   for k in rows[0])
+        cleaner.aggregate(*reducers, **kwargs)
+        return cleaner.flds, sorted(cleaner._output_rows())
+
+    reducers = ('n', Count(output_name='rows'), Max('m', 'max_m'),
+                Min('m', 'min_m'), Mean('m'), DistinctCount('b', 'distinct_b'))
+    flds, result = aggregate(MandolineCleaner, *reducers)
+    assert flds == ['a', 'distinct_b', 'n', 'max_m', 'min_m', 'm', 'rows']
+    assert len(result) == 3
+    assert result[1] == {'a': 1, 'distinct_b': 2, 'n': 145, 'max_m': 3,
+                         'min_m': 0, 'm': 13 / 9.0, 'rows': 10}
+    assert result[0]['m'] == 1.5
+
+    # Spilling groups to disk gives the same result
+    reducers = ('n', DistinctCount('b'), Count())
+    spilled = aggregate(MandolineCleaner, *reducers, max_groups=2)
+    assert spilled == aggregate(MandolineCleaner, *reducers)
+    assert len(spilled[1]) == 13
+
+    # spilled rows are merged as they are read and the spill files removed
+    spill_dir = tempfile.mkdtemp()
+    try:
+        aggregator = HashAggregator(['n'], [Mean('m')], max_groups=2,
+                                    spill_dir=spill_dir)
+        merged = aggregator.aggregate(iter(rows))
+        assert not isinstance(merged, list) and os.listdir(spill_dir)
+        assert len(list(merged)) == 30 and not os.listdir(spill_dir)
+
+        aggregator = HashAggregator(['n'], [Mean('m')], max_groups=2,
+                                    spill_dir=spill_dir)
+        try:
+            aggregator.aggregate(rows + [{'n': 0, 'm': 'x'}])
+        except TypeError:
+            pass
+        else:
+            assert False, "Aggregated a string"
+        assert not os.listdir(spill_dir)
+
+        # and can only be written once
+        cleaner = MandolineCleaner().set_fields(_('a'), _('n'))
+        cleaner.rows = [dict(row) for row in rows]
+        out = os.path.join(spill_dir, "out.csv")
+        cleaner.aggregate('n', max_groups=2, spill_dir=spill_dir).to_csv(out)
+        assert sorted(open(out).read().splitlines()) == \
+            ["0,135", "1,145", "2,155", "a,n"]
+        try:
+            cleaner.to_csv(out)
+        except AssertionError:
+            pass
+        else:
+            assert False, "Wrote spilled rows twice"
+        os.remove(out)
+        assert not os.listdir(spill_dir)
+    finally:
+        shutil.rmtree(spill_dir)
+
+    if columnar.np is not None:
+        assert aggregate(ColumnarCleaner, *reducers, max_groups=2) == spilled
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_masher():
+    for i in range(3):
+        write_sample_csv(os.path.join(tmpdir, "part%d.csv" % i), rows=5)
+    output = os.path.join(tmpdir, "mashed.txt")
+
+    masher = MandolineMasher().files(os.path.join(tmpdir, "*.csv"))
+    masher.to_csv(output, check_headers=True, buffer_size=16)
+    lines = open(output).read().splitlines()
+    assert len(lines) == 16
+    assert lines[0].startswith("Name,")
+    assert lines[6] == lines[1]
+
+    masher.to_csv(output, delete_headers=False)
+    assert len(open(output).read().splitlines()) == 18
+
+    with open(os.path.join(tmpdir, "part3.csv"), 'wb') as f:
+        f.write("Other,Header\n1,2\n")
+    masher.files(os.path.join(tmpdir, "*.csv"))
+    try:
+        masher.to_csv(output, check_headers=True)
+    except AssertionError:
+        pass
+    else:
+        assert False, "Mismatched headers were not detected"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_validators():
+    for i in range(4):
+        write_sample_csv(os.path.join(tmpdir, "part%d.csv" % i), rows=5)
+    write_sample_xlsx(os.path.join(tmpdir, "part.xlsx"))
+
+    header = "Name,State,Date,Count,Extra"
+    files = FileCollection(os.path.join(tmpdir, "*.csv"),
+                           [SizeValidator(100), HeaderValidator(header)])
+    assert files.length == 4
+    assert HeaderValidator("Extra,Name,State,Date,Count,Score,Unused").test(
+        os.path.join(tmpdir, "part.xlsx")) is None
+
+    for validator in (SizeValidator(10000), HeaderValidator("Name")):
+        try:
+            FileCollection(os.path.join(tmpdir, "*.csv"), [validator])
+        except AssertionError:
+            pass
+        else:
+            assert False, "File should not have passed " + validator.description
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_json_layouts():
+    import json
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=2500)
+
+    cleaner = MandolineCleaner()
+    cleaner.files(fn).set_fields(_('Name'), _('Count', Int())).clean()
+    cleaner.to_json("rows.json")
+    content = open(os.path.join(tmpdir, "rows.json")).read()
+    assert content.startswith('{"rows":[{')
+    assert ', ' not in content and ': ' not in content
+    assert json.loads(content)["rows"] == cleaner.rows
+
+    cleaner.to_json("arrays.json", layout="arrays")
+    doc = json.load(open(os.path.join(tmpdir, "arrays.json")))
+    assert doc["fields"] == ["Name", "Count"]
+    assert len(doc["rows"]) == 2500
+    assert doc["rows"][7] == ["name 7", 7]
+
+
+def test_csv_writer():
+    import cStringIO
+    rows = [{'a': u'caf\xe9', 'b': 1, 'c': 'x'}, {'a': None, 'b': 2.5},
+            {'a': 'plain, "quoted"', 'b': 3, 'extra': 'ignored'}]
+
+    old = cStringIO.StringIO()
+    writer = DictUnicodeWriter(old, ['a', 'b', 'c'], extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+    new = cStringIO.StringIO()
+    writer = BufferedDictUnicodeWriter(new, ['a', 'b', 'c'], batch_size=2)
+    writer.writeheader()
+    writer.writerows(rows)
+    assert new.getvalue() == old.getvalue()
+
+
+class FakeMultipartUpload(object):
+    def __init__(self, failures):
+        self.parts = {}
+        self.failures = failures
+        self.completed = False
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        if self.failures.get(part_num):
+            self.failures[part_num] -= 1
+            raise IOError("connection reset")
+        self.parts[part_num] = fp.read()
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.parts = {}
+
+
+class FakeBucket(object):
+    def __init__(self, failures={}):
+        self.failures = dict(failures)
+        self.uploads = []
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        self.headers = headers
+        mp = FakeMultipartUpload(self.failures)
+        self.uploads.append(mp)
+        return mp
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_s3_multipart_upload():
+    from mandoline.s3upload import S3Uploader
+    fn = os.path.join(tmpdir, "upload.json")
+    content = "".join(chr(i % 256) for i in xrange(10000))
+    with open(fn, "wb") as f:
+        f.write(content)
+
+    bucket = FakeBucket(failures={2: 2})
+    uploader = S3Uploader(bucket, part_size=1024, threads=3, retry_delay=0)
+    assert uploader.upload(fn, "upload.json") == 10000
+    mp = bucket.uploads[0]
+    assert mp.completed
+    assert sorted(mp.parts) == range(1, 11)
+    assert "".join(mp.parts[i] for i in sorted(mp.parts)) == content
+
+    bucket = FakeBucket(failures={3: 5})
+    uploader = S3Uploader(bucket, part_size=1024, retries=1, retry_delay=0)
+    try:
+        uploader.upload(fn, "upload.json")
+        assert False, "Expected the upload to fail"
+    except IOError:
+        pass
+    assert not bucket.uploads[0].completed
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_clean_cache():
+    cache_dir = os.path.join(tmpdir, "cache")
+    for i in range(3):
+        write_sample_csv(os.path.join(tmpdir, "day%d.csv" % i), rows=20)
+    pattern = os.path.join(tmpdir, "day*.csv")
+
+    cleaned = []
+
+    def count(d, fn):
+        cleaned.append(d[fn])
+
+    def run(*fields):
+        cleaner = MandolineCleaner()
+        return cleaner.files(pattern).set_fields(*fields).clean(
+            cache_dir=cache_dir)
+
+    fields = (_('Name', CleanWith(count)), _('Count', Int()))
+    first = run(*fields).rows
+    assert len(cleaned) == 60
+
+    del cleaned[:]
+    assert run(*fields).rows == first
+    assert len(cleaned) == 0
+
+    # Only the changed file is cleaned again
+    write_sample_csv(os.path.join(tmpdir, "day1.csv"), rows=30)
+    del cleaned[:]
+    assert len(run(*fields).rows) == 70
+    assert len(cleaned) == 30
+
+    # Touching a file without changing it doesn't clean it again
+    os.utime(os.path.join(tmpdir, "day2.csv"), (0, 0))
+    del cleaned[:]
+    run(*fields)
+    assert len(cleaned) == 0
+
+    # Changing the fields cleans everything
+    rows = run(_('Name', CleanWith(count)), _('Count')).rows
+    assert len(cleaned) == 70
+    assert rows[0]['Count'] == '0'
+
+    # So does changing a value a cleaning function closes over
+    def truncate(n):
+        def clean(d, fn):
+            cleaned.append(d[fn])
+            d[fn] = d[fn][:n]
+        return clean
+
+    for n in (2, 5, 5):
+        del cleaned[:]
+        rows = run(_('Name', CleanWith(truncate(n)))).rows
+        assert rows[0]['Name'] == 'name 0'[:n]
+    assert len(cleaned) == 0
+
+    mapping = {'name 0': 'first'}
+    for value, expected in (('a', 70), ('b', 70), ('b', 0)):
+        mapping['name 0'] = value
+        del cleaned[:]
+        rows = run(_('Name', CleanWith(
+            lambda d, fn, mapping=dict(mapping): count(d, fn) or
+            d.__setitem__(fn, mapping.get(d[fn], d[fn]))))).rows
+        assert rows[0]['Name'] == value
+        assert len(cleaned) == expected
+
+    # Compiled regexes are described by their pattern
+    import re
+    for source, expected in ((r'\d', 70), (r'\d', 0), (r'\d+', 70)):
+        regex = re.compile(source)
+        del cleaned[:]
+        rows = run(_('Name', CleanWith(
+            lambda d, fn: count(d, fn) or
+            d.__setitem__(fn, regex.sub('#', d[fn]))))).rows
+        assert rows[0]['Name'] == 'name #'
+        assert len(cleaned) == expected
+
+    # A new cache version cleans everything again
+    from mandoline import filecache
+    version = filecache.CACHE_VERSION
+    try:
+        filecache.CACHE_VERSION += 1
+        del cleaned[:]
+        run(*fields)
+        assert len(cleaned) == 70
+    finally:
+        filecache.CACHE_VERSION = version
+
+    # Values that can't be described turn the cache off
+    handle = open(os.path.join(tmpdir, "day0.csv"))
+    del cleaned[:]
+    run(_('Name', CleanWith(lambda d, fn: count(d, fn) or handle)))
+    run(_('Name', CleanWith(lambda d, fn: count(d, fn) or handle)))
+    assert len(cleaned) == 140
+    handle.close()
+
+
+def start_stub_slice_server():
+    """
+    Serve a few sliceboards over HTTP/1.1 on a free local port, counting
+    the connections that are opened and the requests made
+    """
+    import BaseHTTPServer
+    import json
+    import SocketServer
+    import threading
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def respond(self, status, obj=None, headers={}):
+            body = json.dumps(obj) if obj is not None else ""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def sliceboard_id(self):
+            parts = self.path.split("?")[0].strip("/").split("/")
+            return int(parts[3])
+
+        def do_GET(self):
+            server.requests.append(("GET", self.path))
+            if self.path.startswith("/api/v1/sliceboard/?"):
+                return self.list_sliceboards()
+            sliceboard_id = self.sliceboard_id()
+            if sliceboard_id == 404:
+                return self.respond(404, {})
+            if "/duplicate" in self.path:
+                return self.respond(200, {"id": sliceboard_id + 1000})
+            etag = '"%d"' % server.versions.get(sliceboard_id, 0)
+            if self.headers.get("If-None-Match") == etag:
+                return self.respond(304, headers={"ETag": etag})
+            self.respond(200, {"id": sliceboard_id,
+                               "title": "Board %d" % sliceboard_id,
+                               "data": "/api/v1/data/%d" % sliceboard_id,
+                               "thinSlices": []},
+                         headers={"ETag": etag})
+
+        def list_sliceboards(self):
+            import urlparse
+            query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            limit, offset = int(query["limit"][0]), int(query["offset"][0])
+            ids = range(offset + 1, min(offset + limit, 250) + 1)
+            next_page = "/next" if offset + limit < 250 else None
+            self.respond(200, {
+                "meta": {"total_count": 250, "next": next_page},
+                "objects": [{"id": i, "title": "Board %d" % i,
+                             "thinSlices": []} for i in ids]})
+
+        def do_PUT(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            server.requests.append(("PUT", self.path))
+            if self.path.startswith("/api/v1/sliceboard/"):
+                sliceboard_id = self.sliceboard_id()
+                server.versions[sliceboard_id] = \
+                    server.versions.get(sliceboard_id, 0) + 1
+            self.respond(202)
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+        def process_request(self, request, client_address):
+            self.connections += 1
+            SocketServer.ThreadingMixIn.process_request(
+                self, request, client_address)
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.connections = 0
+    server.requests = []
+    server.versions = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def test_slice_batch():
+    server = start_stub_slice_server()
+    try:
+        url = "127.0.0.1:%d" % server.server_address[1]
+        ms = MandolineSlice(url, pool_size=4).authenticate("user", "key")
+        ms.batch(range(1, 41), "duplicate")
+        assert sorted(ms.batch_results) == range(1, 41)
+        assert ms.batch_errors == {}
+        assert ms.batch_results[7].duplicate_obj == {"id": 1007}
+        assert len(server.requests) == 80
+        # connections are kept alive and shared by the threads
+        assert server.connections <= 4
+
+        ms.batch([3, 404], "replace_data", "rows.json")
+        assert sorted(ms.batch_results) == [3]
+        assert sorted(ms.batch_errors) == [404]
+        assert ("PUT", "/api/v1/data/3/set_rows_cache"
+                "?api_key=key&username=user") in server.requests
+
+        ms.batch([5], lambda s: s.title("Copy of {0[title]}"))
+        assert sorted(ms.batch_results) == [5]
+
+        limited = MandolineSlice(url, rate_limit=1000).authenticate("u", "k")
+        limited.batch(range(1, 11), "duplicate").show_batch_results()
+        assert len(limited.batch_results) == 10
+    finally:
+        server.shutdown()
+
+
+def test_slice_batch_stub_session():
+    class Response(object):
+        status_code = 200
+        headers = {}
+
+        def __init__(self, obj):
+            self.obj = obj
+
+        def json(self):
+            return self.obj
+
+    class StubSession(object):
+        """ Answers every GET without a connection pool or adapters
+        """
+        def get(self, url, **kwargs):
+            sliceboard_id = int(url.split("?")[0].rstrip("/").split("/")[-1])
+            return Response({"id": sliceboard_id, "title": "Board",
+                             "thinSlices": []})
+
+    ms = MandolineSlice("stub", session=StubSession()).authenticate("u", "k")
+    ms.batch([1, 2, 3], lambda other: None)
+    assert sorted(ms.batch_results) == [1, 2, 3]
+    assert ms.batch_errors == {}
+
+
+def test_rate_limiter():
+    import time
+    from mandoline.ratelimit import RateLimiter, host_rate_limiter
+    limiter = RateLimiter(50, burst=5)
+    start = time.time()
+    for i in range(15):
+        limiter.wait()
+    # the first 5 are a burst, the other 10 are spread over 0.2 seconds
+    assert 0.15 < time.time() - start < 1
+
+    # every client of a host shares one limiter, whatever rate it asks for
+    first = host_rate_limiter("limited.example.com", 10)
+    second = host_rate_limiter("limited.example.com", 20)
+    assert first is second
+    assert first.rate == 20 and first.burst == 20
+
+
+def test_sliceboard_cache():
+    import time
+    server = start_stub_slice_server()
+    try:
+        url = "127.0.0.1:%d" % server.server_address[1]
+        ms = MandolineSlice(url, cache_ttl=60).authenticate("user", "key")
+        for i in range(5):
+            ms.sliceboard(3)
+        assert len(server.requests) == 1
+
+        # changes are seen right away
+        ms.title("Copy of {0[title]}")
+        ms.sliceboard(3)
+        assert len(server.requests) == 3
+
+        # stale sliceboards are revalidated and reused if unchanged
+        ms = MandolineSlice(url, cache_ttl=0).authenticate("user", "key")
+        first = ms.sliceboard(4).sliceboard_obj
+        assert ms.sliceboard(4).sliceboard_obj is first
+        assert len(server.requests) == 5
+
+        del server.requests[:]
+        boards = list(ms.iter_sliceboards(page_size=100, fields=["id", "title"]))
+        assert [sb["id"] for sb in boards] == range(1, 251)
+        assert boards[0] == {"id": 1, "title": "Board 1"}
+        assert len(server.requests) == 3
+    finally:
+        server.shutdown()
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_benchmark():
+    import json
+    from mandoline.benchmark import main
+    output = os.path.join(tmpdir, "results.json")
+    main(["--rows", "200", "--xlsx-rows", "20", "--width", "7",
+          "--startup", "--output", output])
+    report = json.load(open(output))
+    assert report["width"] == 7
+    stages = [(r["format"], r["stage"]) for r in report["results"]]
+    assert ("csv", "clean") in stages
+    assert ("xlsx", "load") in stages
+    assert ("csv", "MandolineMasher.to_csv") in stages
+    assert ("python", "import mandoline") in stages
+    assert all(r["peak_memory_kb"] > 0 for r in report["results"])
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_metrics():
+    import json
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=300)
+
+    def slow_name(d, fn):
+        d[fn] = d[fn].upper()
+
+    finished = []
+    cleaner = MandolineCleaner().instrument(
+        hook=lambda stage: finished.append(stage.name), profile=True,
+        time_cleaners=True)
+    cleaner.files(fn).set_fields(_('Name', CleanWith(slow_name)),
+                                 _('Count', Int()))
+    cleaner.clean().aggregate("Count").to_json("out.json")
+
+    assert finished == ['load', 'clean', 'aggregate', 'to_json']
+    load = cleaner.report.stage('load')[0]
+    assert load.rows == 300 and load.bytes_read == os.path.getsize(fn)
+    assert cleaner.report.stage('to_json')[0].bytes_written > 0
+    assert 'slow_name' in cleaner.report.stage('clean')[0].profile_text()
+    assert set(cleaner.report.cleaner_seconds) == set(
+        [('Name', 'CleanWith(slow_name)'), ('Count', 'Int')])
+    report = json.loads(json.dumps(cleaner.report.to_dict()))
+    assert [s['name'] for s in report['stages']] == finished
+
+
+def test_memoize():
+    calls = []
+
+    def shout(d, fn):
+        calls.append(d[fn])
+        d[fn] = d[fn].upper() + "!"
+
+    cleaner = Memoize(shout, cache_size=2)
+    rows = [{'a': v} for v in ["x", "y", "x", "x", "z", "y", "x"]]
+    for row in rows:
+        cleaner.clean(row, 'a')
+    assert [row['a'] for row in rows] == ["X!", "Y!", "X!", "X!", "Z!", "Y!",
+                                          "X!"]
+    # z evicted x, the oldest value, and x then evicted y
+    assert calls == ["x", "y", "z", "x"]
+    assert cleaner.hits == 3 and cleaner.hit_rate == 3 / 7.0
+
+    # without a cache every value is cleaned
+    del calls[:]
+    cleaner = Memoize(shout, cache_size=0)
+    for v in ["x", "x"]:
+        cleaner.clean({'a': v}, 'a')
+    assert calls == ["x", "x"] and cleaner.hits == 0
+
+    lookup = Lookup({"New York": "NY", "st. louis": "STL"}, normalize=True)
+    for value, expected in (("new  york", "NY"), ("NEW YORK.", "NY"),
+                            ("St Louis", "STL"), ("Boston", "Boston")):
+        d = {'a': value}
+        lookup.clean(d, 'a')
+        assert d['a'] == expected
+
+    d = {'a': ' district of columbia. '}
+    StateAbbrevLookup().clean(d, 'a')
+    assert d['a'] == 'DC'
+    d = {'a': 'Narnia'}
+    StateAbbrevLookup(default='').clean(d, 'a')
+    assert d['a'] == ''
+
+    # the normalized index is never evicted from the results cache
+    lookup = StateAbbrevLookup()
+    lookup._resolved.maxsize = 2
+    for value in ["Texas", "ohio", "Narnia", "Virginia", "TEXAS"]:
+        lookup.clean({'a': value}, 'a')
+    assert len(lookup._resolved) == len(lookup.states) + 2
+    assert "Virginia" in lookup._resolved and "Texas" not in lookup._resolved
+    import cPickle
+    date = cPickle.loads(cPickle.dumps(Date(cache_size=10)))
+    d = {'a': "01-02-2013"}
+    date.clean(d, 'a')
+    assert d['a'] == Date().parse("01-02-2013") and len(date.cache) == 1
+
+
+def test_numbers():
+    for value, expected in (("12", 12), ("-12", -12), (" 7 ", 7), (3.0, 3),
+                            ("3.0", 3), ("3.5", 0), ("1,234", 0),
+                            ("fred", 0), (None, 0), (5, 5)):
+        d = {'a': value}
+        Int().clean(d, 'a')
+        assert d['a'] == expected, (value, d['a'])
+
+    for value, expected in (("1,234", 1234), ("-12,345,678", -12345678),
+                            ("1,5", None), ("2,25", None), ("1,2,3", None),
+                            ("1234,567", None), (",123", None)):
+        assert Int(None, thousands=",").parse(value) == expected, value
+    d = {'a': "fred"}
+    Int(None).clean(d, 'a')
+    assert d['a'] is None
+
+    for value, expected in (("1.5", 1.5), ("-2", -2.0), ("fred", None),
+                            ("nan", None), ("", None)):
+        d = {'a': value}
+        Float().clean(d, 'a')
+        assert d['a'] == expected, (value, d['a'])
+    d = {'a': "1.234,5"}
+    Float(thousands=".", decimal=",").clean(d, 'a')
+    assert d['a'] == 1234.5
+    assert Float(thousands=",").parse("2,25") is None
+    assert Float(thousands=",").parse("1,234.5") == 1234.5
+    european = Float(thousands=".", decimal=",")
+    assert european.parse("1.234") == 1234.0
+    assert european.parse("2.500,5") == 2500.5
+    assert Int(None, thousands=".", decimal=",").parse("1.234") == 1234
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        from mandoline.columnar import _float_column, _import_numpy
+        _import_numpy()
+        floats = _float_column(european, numpy.array(["1.234", "2.500"]))
+        assert list(floats) == [1234.0, 2500.0]
+
+    from mandoline.schema import infer_column
+    column = infer_column('x', ['1,5', '2,25', '3,75'])
+    assert (column.type, column.thousands, column.decimal) == ('float', '.', ',')
+    d = {'x': '2,25'}
+    column.field().clean(d)
+    assert d['x'] == 2.25
+    column = infer_column('x', ['1,234', '5', '12,000'])
+    assert (column.type, column.thousands) == ('int', ',')
+    assert infer_column('x', ['1,2,3', 'a']).type == 'string'
+    column = infer_column('x', ['1.234', '2.500,5'])
+    assert (column.type, column.thousands, column.decimal) == ('float', '.', ',')
+    d = {'x': '1.234'}
+    column.field().clean(d)
+    assert d['x'] == 1234.0
+    assert infer_column('zip', ['02134', '00501']).type == 'string'
+    assert infer_column('zip', ['02134', '02134', '02134', '10001']).type == 'categorical'
+    assert infer_column('x', ['0', '0.5', '-0,25', '12']).type == 'string'
+    assert infer_column('x', ['0', '0.5', '12']).type == 'float'
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_infer_fields():
+    fn = os.path.join(tmpdir, "typed.csv")
+    with open(fn, "w") as f:
+        f.write("Id,Price,When,Color,Note,Blank\n")
+        for i in range(100):
+            f.write('%d,"%d,%03d.50",%02d-01-2013,%s,note %d,\n' % (
+                -i, i, i, i % 12 + 1, ["red", "blue"][i % 2], i))
+
+    cleaner = MandolineCleaner().files(fn).infer_fields(sample_size=50)
+    types = dict((c.name, c.type) for c in cleaner.schema)
+    assert types == {"Id": "int", "Price": "float", "When": "date",
+                     "Color": "categorical", "Note": "string",
+                     "Blank": "empty"}
+    cleaner.show_schema()
+    rows = cleaner.clean().rows
+    assert len(rows) == 100
+    assert rows[3]["Id"] == -3
+    assert rows[3]["Price"] == 3003.5
+    assert rows[3]["When"] == Date().parse("04-01-2013")
+    assert rows[3]["Color"] == "blue"
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_csv_chunks():
+    import csv
+    from mandoline.csvchunks import read_range, record_ranges
+    fn = os.path.join(tmpdir, "quoted.csv")
+    with open(fn, "wb") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Name", "Note", "Count"])
+        for i in range(500):
+            note = ['plain', 'two\nlines "quoted"', 'comma, "and"\r\nmore'][i % 3]
+            writer.writerow(["name %d" % i, note, str(i)])
+    expected = list(csv.reader(open(fn, "rb")))[1:]
+
+    for chunk_size in (1, 50, 777, 10 ** 6):
+        ranges = record_ranges(fn, chunk_size)
+        assert ranges[-1][1] == os.path.getsize(fn)
+        rows = []
+        for start, end in ranges:
+            rows.extend(csv.reader(read_range(fn, start, end).splitlines(True)))
+        assert rows == expected, chunk_size
+
+    fields = (_('Name'), _('Note'), _('Count', Int()))
+    sequential = MandolineCleaner().files(fn).set_fields(*fields).clean().rows
+    cleaner = MandolineCleaner().files(fn).set_fields(*fields)
+    chunked = cleaner.clean(workers=3, chunk_size=2000).rows
+    assert chunked == sequential
+    assert len(chunked) == 500 and chunked[499]["Count"] == 499
+
+    # records that end with a bare carriage return
+    fn = os.path.join(tmpdir, "mac.csv")
+    with open(fn, "wb") as f:
+        f.write("Name,Count\r")
+        for i in range(300):
+            f.write('"name\r%d",%d\r' % (i, i))
+    fields = (_('Name'), _('Count', Int()))
+    ranges = record_ranges(fn, 500)
+    assert len(ranges) > 1 and ranges[-1][1] == os.path.getsize(fn)
+    sequential = MandolineCleaner().files(fn).set_fields(*fields).clean().rows
+    cleaner = MandolineCleaner().files(fn).set_fields(*fields)
+    chunked = cleaner.clean(workers=2, chunk_size=500).rows
+    assert len(sequential) == 300
+    assert chunked == sequential
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_compact_rows():
+    import cPickle
+    import json
+    from mandoline.rows import CompactRow, RowSchema
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=40)
+
+    def fields():
+        return (_('Name=>Full Name'),
+                _('State', StateAbbrevLookup()),
+                _('Count', Int()))
+
+    dicts = MandolineCleaner().files(fn).set_fields(*fields()).clean()
+    compact = MandolineCleaner(compact_rows=True)
+    compact.files(fn).set_fields(*fields()).clean()
+    assert all(isinstance(row, CompactRow) for row in compact.rows)
+    assert compact.rows == dicts.rows
+    assert compact.rows[3]["Full Name"] == "name 3"
+    assert compact.rows[3].get("Name") is None
+
+    row = compact.rows[0]
+    row["Note"] = "extra"
+    assert row["Note"] == "extra" and "Note" in row
+    del row["State"]
+    assert "State" not in row and row.get("State", "-") == "-"
+    assert sorted(row.keys()) == ["Count", "Full Name", "Note"]
+    assert cPickle.loads(cPickle.dumps(row, 2)) == row
+
+    for cleaner in (dicts, compact):
+        cleaner.to_csv(os.path.join(tmpdir, "out.csv"))
+        cleaner.to_json(os.path.join(tmpdir, "out.json"))
+        cleaner.to_json(os.path.join(tmpdir, "arrays.json"), layout="arrays")
+    compact_rows = json.load(open(os.path.join(tmpdir, "out.json")))["rows"]
+    # keys that aren't output fields are not written
+    assert compact_rows[0] == {"Full Name": "name 0", "Count": 0}
+    assert compact_rows[1] == {"Full Name": "name 1", "State": "VA",
+                               "Count": 1}
+    arrays = json.load(open(os.path.join(tmpdir, "arrays.json")))
+    assert arrays["rows"][0] == ["name 0", None, 0]
+    assert open(os.path.join(tmpdir, "out.csv")).readlines()[1] == \
+        "name 0,,0\r\n"
+
+    compact.refine_fieldnames().to_json(os.path.join(tmpdir, "out.json"))
+    refined = json.load(open(os.path.join(tmpdir, "out.json")))["rows"]
+    assert refined[0] == {"full_name": "name 0", "count": 0}
+
+    aggregated = MandolineCleaner(compact_rows=True).files(fn)
+    aggregated.set_fields(*fields()).clean().aggregate("Count")
+    assert aggregated.rows == dicts.aggregate("Count").rows
+
+    schema = RowSchema(["a", "b"])
+    assert CompactRow(schema, [1, 2]).as_dict() == {"a": 1, "b": 2}
+
+
+@with_setup(make_tmpdir, remove_tmpdir)
+def test_refine_and_drop_fields():
+    import json
+    from mandoline.columnar import ColumnarCleaner
+    fn = write_sample_csv(os.path.join(tmpdir, "sample.csv"), rows=20)
+    out = os.path.join(tmpdir, "out")
+
+    for engine in (MandolineCleaner, ColumnarCleaner):
+        cleaner = engine().files(fn).set_fields(
+            _('Name=>Full Name'), _('State', StateAbbrevLookup()),
+            _('Date', Date()), _('Count', Int())).clean()
+        rows = cleaner.rows
+        first = rows[0] if rows else None
+        cleaner.refine_fieldnames().drop_field(["date", "State"])
+        if engine is MandolineCleaner:
+            # rows are not copied or changed, only written differently
+            assert cleaner.rows is rows and rows[0] is first
+            assert sorted(first) == ["Count", "Date", "Full Name", "State"]
+
+        cleaner.to_csv(out + ".csv")
+        lines = open(out + ".csv").read().splitlines()
+        assert len(lines) == 21, engine
+        assert lines[:2] == ["full_name,count", "name 0,0"], engine
+        cleaner.to_json(out + ".json")
+        assert json.load(open(out + ".json"))["rows"][1] == \
+            {"full_name": "name 1", "count": 1}
+        cleaner.to_json(out + ".arrays.json", layout="arrays")
+        arrays = json.load(open(out + ".arrays.json"))
+        assert arrays["fields"] == ["full_name", "count"]
+        assert arrays["rows"][1] == ["name 1", 1]
+
+        # fields keep their names for aggregate and are refined when written
+        cleaner.drop_field("Full Name").aggregate("Count")
+        cleaner.to_json(out + ".json")
+        assert json.load(open(out + ".json"))["rows"] == \
+            [{"count": sum(range(20))}], engine
@@ -3,6 +3,7 @@ Validators test to make sure a file matches
 """
 
 import logging
+import os
 
 logger = logging.getLogger("mandoline.validator")
 
@@ -27,8 +28,7 @@ class SizeValidator(FileValidator):
             len=length)
 
     def test(self, f):
-        content = open(f, 'r').read()
-        assert len(content) >= self.length
+        assert os.path.getsize(f) >= self.length
         logger.debug(f + " passed " + self.description)
 
 
@@ -43,9 +43,24 @@ class HeaderValidator(FileValidator):
             header=self.header[:40])
 
     def test(self, f):
-        lines = open(f, 'r').readlines()
-        file_header = lines[0].rstrip('\n')
+        if f.endswith("xlsx"):
+            file_header = self.xlsx_header(f)
+        else:
+            with open(f, 'r') as inf:
+                file_header = inf.readline().rstrip('\n')
         assert file_header == self.header
         logger.debug(f + " passed " + self.description)
 
+    def xlsx_header(self, f):
+        """
+        The first row of the first sheet, joined with commas
+        """
+        from openpyxl import load_workbook
+
+        wb = load_workbook(f, use_iterators=True)
+        sht = wb.get_sheet_by_name(wb.get_sheet_names()[0])
+        row = next(sht.iter_rows(), ())
+        return u",".join(u"" if cell.internal_value is None
+                         else unicode(cell.internal_value) for cell in row)
+
 